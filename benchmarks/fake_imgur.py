@@ -0,0 +1,226 @@
+#!/bin/env python3
+## Local stand-in for the Imgur API serving synthetic gallery pages, albums and images
+## Responses are shaped like the ones `Ingest` consumes, including rate limit headers
+##   and ETags, so redrum can be tested and benchmarked without touching the real API
+
+## examples:
+##   fake_imgur.py --port 8765 --pages 5 --latency 0.05
+##   fake_imgur.py --port 8765 --quota 200 --error_rate 0.1  # test rate limiting and retries
+## then point redrum at it in redrum.ini:
+##   url = http://127.0.0.1:8765/3/gallery/r/{0}/top/all/{1}
+##   album_url = http://127.0.0.1:8765/3/album/{0}
+
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+
+try:
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer as ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body, content_type='application/json', headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        parts = self.path.strip('/').split('/')
+        time.sleep(server.latency)
+
+        # images don't count against the api quota
+        if parts[0] == 'i':
+            server.count('images', len(server.image_data))
+            return self.send(200, server.image_data, 'image/jpeg')
+
+        headers = server.take_quota()
+        if headers is None:
+            body = json.dumps({'success': False, 'status': 429, 'data': {'error': 'Too Many Requests'}})
+            return self.send(429, body.encode('utf-8'), headers=server.quota_headers())
+        if server.fail():
+            return self.send(500, b'<html>Internal Server Error</html>', 'text/html', headers)
+
+        # /3/gallery/r/<subreddit>/top/all/<page>
+        if parts[:3] == ['3', 'gallery', 'r'] and len(parts) == 7:
+            kind = 'pages'
+            data = server.page(parts[3], int(parts[6]))
+        # /3/album/<id>
+        elif parts[:2] == ['3', 'album'] and len(parts) == 3:
+            kind = 'albums'
+            data = {'id': parts[2], 'images': server.album(parts[2])}
+        else:
+            body = json.dumps({'success': False, 'status': 404, 'data': {'error': 'Not Found'}})
+            return self.send(404, body.encode('utf-8'), headers=headers)
+
+        body = json.dumps({'success': True, 'status': 200, 'data': data}).encode('utf-8')
+        headers['ETag'] = '"{0:08x}"'.format(zlib.crc32(body))
+        if self.headers.get('If-None-Match') == headers['ETag']:
+            server.count(kind)
+            return self.send(304, b'', headers=headers)
+        server.count(kind, len(body))
+        self.send(200, body, headers=headers)
+
+
+class FakeImgur(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, pages=5, page_size=60, album_ratio=0.1, album_size=5,
+                 latency=0, quota=None, error_rate=0, image_size=1024, seed=0, duplicate_ratio=0, image=None):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.pages = pages
+        self.page_size = page_size
+        self.album_ratio = album_ratio
+        self.album_size = album_size
+        self.duplicate_ratio = duplicate_ratio
+        self.latency = latency
+        self.quota = quota
+        self.error_rate = error_rate
+        # every image link serves the file at `image`, or `image_size` zero bytes
+        if image:
+            with open(image, 'rb') as f:
+                self.image_data = f.read()
+        else:
+            self.image_data = b'\0' * image_size
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.rng = random.Random(seed)
+        self.counts = {'requests': 0, 'pages': 0, 'albums': 0, 'images': 0, 'bytes': 0}
+        self.reset = int(time.time()) + 3600
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server_address[1])
+
+    # config options pointing redrum at this server
+    def options(self):
+        return {'url': self.url + '/3/gallery/r/{0}/top/all/{1}',
+                'album_url': self.url + '/3/album/{0}'}
+
+    def random(self, *key):
+        return random.Random(zlib.crc32(repr((self.seed,) + key).encode('utf-8')))
+
+    # count a response and the bytes sent
+    def count(self, name, size=0):
+        with self.lock:
+            self.counts[name] += 1
+            self.counts['bytes'] += size
+
+    # whether to inject a server error
+    def fail(self):
+        with self.lock:
+            return self.rng.random() < self.error_rate
+
+    def quota_headers(self):
+        remaining = max(self.quota, 0) if self.quota is not None else 12500
+        return {'X-RateLimit-ClientLimit': '12500',
+                'X-RateLimit-ClientRemaining': str(remaining),
+                'X-RateLimit-UserLimit': '2000',
+                'X-RateLimit-UserRemaining': str(min(remaining, 2000)),
+                'X-RateLimit-UserReset': str(self.reset)}
+
+    # use up one api request, returning rate limit headers or None if the quota is exhausted
+    def take_quota(self):
+        with self.lock:
+            self.counts['requests'] += 1
+            if self.quota is not None:
+                if self.quota <= 0:
+                    return None
+                self.quota -= 1
+        return self.quota_headers()
+
+    # imgur style metadata for one image
+    def image(self, image_id, rand):
+        width, height = rand.choice([(0, 0), (1280, 720), (1920, 1080), (2560, 1440),
+                                     (3840, 2160), (6000, 4000), (1080, 1920), (800, 600)])
+        return {'id': image_id,
+                'title': 'Synthetic image {0}'.format(image_id),
+                'description': 'A synthetic image served by fake_imgur. ' * rand.randint(0, 5),
+                'datetime': 1480000000 + rand.randint(0, 10 ** 8),
+                'type': 'image/jpeg',
+                'animated': False,
+                'width': width,
+                'height': height,
+                'size': width * height // 4,
+                'views': int(rand.paretovariate(1.2) * 1000),
+                'bandwidth': 0,
+                'nsfw': rand.random() < 0.05,
+                'account_url': 'user{0}'.format(rand.randint(0, 1000)),
+                'tags': [],
+                'is_album': False,
+                'link': '{0}/i/{1}.jpg'.format(self.url, image_id)}
+
+    def page(self, subreddit, page_num):
+        if page_num >= self.pages:
+            return []
+        results = []
+        for i in range(self.page_size):
+            result_id = '{0}{1}x{2}'.format(subreddit, page_num, i)
+            rand = self.random(result_id)
+            # cross-posts have the same id in every subreddit they appear in
+            if rand.random() < self.duplicate_ratio:
+                shared_id = 'x{0}x{1}'.format(page_num, i)
+                results.append(self.image(shared_id, self.random(shared_id)))
+            elif rand.random() < self.album_ratio:
+                results.append({'id': result_id, 'title': 'Synthetic album {0}'.format(result_id),
+                                'is_album': True, 'images_count': self.album_size,
+                                'views': int(rand.paretovariate(1.2) * 1000), 'nsfw': False,
+                                'link': '{0}/a/{1}'.format(self.url, result_id)})
+            else:
+                results.append(self.image(result_id, rand))
+        return results
+
+    def album(self, album_id):
+        return [self.image('{0}a{1}'.format(album_id, i), self.random(album_id, i))
+                for i in range(self.album_size)]
+
+    # serve in a background thread
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Imgur API.")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--pages', type=int, default=5, help="pages per subreddit")
+    parser.add_argument('--page_size', type=int, default=60, help="results per page")
+    parser.add_argument('--album_ratio', type=float, default=0.1, help="fraction of results which are albums")
+    parser.add_argument('--album_size', type=int, default=5, help="images per album")
+    parser.add_argument('--duplicate_ratio', type=float, default=0, help="fraction of results which are cross-posts shared with other subreddits")
+    parser.add_argument('--latency', type=float, default=0, help="seconds to wait before each response")
+    parser.add_argument('--quota', type=int, default=None, help="api requests allowed before responding 429")
+    parser.add_argument('--error_rate', type=float, default=0, help="fraction of api requests failing with 500")
+    parser.add_argument('--image', metavar='PATH', help="serve this file for every image, eg. a large jpeg to test resizing")
+    args = parser.parse_args()
+
+    server = FakeImgur(args.port, args.pages, args.page_size, args.album_ratio, args.album_size,
+                       args.latency, args.quota, args.error_rate, duplicate_ratio=args.duplicate_ratio,
+                       image=args.image)
+    print("Serving fake Imgur API at {0}".format(server.url))
+    for option, value in server.options().items():
+        print("{0} = {1}".format(option, value))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
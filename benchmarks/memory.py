@@ -0,0 +1,105 @@
+#!/bin/env python3
+## Peak memory benchmark for redrum against a local fake Imgur API
+## Measures peak traced memory during a refresh from a cold start, memory held by the
+##   refreshed images afterwards, and memory held and at its peak while loading the saved cache
+
+## examples:
+##   python benchmarks/memory.py                          # 100k images
+##   python benchmarks/memory.py --sizes 10000 100000 --formats json binary
+
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from redrum import redrum
+from phases import config_template, free_port, start_server, pages_for
+
+
+# megabytes of traced memory allocated while running `function`, and at its peak
+def traced(function, *args):
+    gc.collect()
+    tracemalloc.start()
+    result = function(*args)
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current / 1e6, peak / 1e6
+
+
+def run(args, size, port):
+    rows = {}
+    with tempfile.TemporaryDirectory() as directory:
+        config_path = os.path.join(directory, 'redrum.ini')
+        url = 'http://127.0.0.1:{0}'.format(port)
+        with open(config_path, 'w') as f:
+            f.write(config_template.format(
+                directory=directory,
+                subreddits='\n    '.join('sub{0}'.format(i) for i in range(args.subreddits)),
+                pages=pages_for(args, size),
+                url=url + '/3/gallery/r/{0}/top/all/{1}',
+                album_url=url + '/3/album/{0}',
+                max_concurrency=args.max_concurrency))
+        config = redrum.Config(config_path)
+
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                (date, images, scores, _, _), held, peak = traced(redrum.refresh, config)
+                rows['refresh peak'] = peak
+                rows['images held'] = held
+                seen = redrum.Seen()
+                indexes = redrum.build_indexes(config, images, scores, seen)
+                for cache_format in args.formats:
+                    config.cache_format = cache_format
+                    redrum.save(config, images, scores, indexes, date, seen)
+                    rows[cache_format + ' size'] = os.path.getsize(config.cache_file) / 1e6
+                    state, rows['load ' + cache_format + ' held'], rows['load ' + cache_format + ' peak'] = \
+                        traced(redrum.load_state, config)
+                    del state
+            finally:
+                sys.stdout = stdout
+    return len(images), rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure peak memory of redrum against a local fake Imgur API.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100000], help="approximate number of images")
+    parser.add_argument('--formats', nargs='+', default=['json', 'binary'], help="cache formats to save and load")
+    parser.add_argument('--subreddits', type=int, default=10, help="number of subreddits")
+    parser.add_argument('--page_size', type=int, default=60, help="results per page")
+    parser.add_argument('--album_ratio', type=float, default=0.1, help="fraction of results which are albums")
+    parser.add_argument('--album_size', type=int, default=5, help="images per album")
+    parser.add_argument('--duplicate_ratio', type=float, default=0, help="fraction of results which are cross-posts shared with other subreddits")
+    parser.add_argument('--latency', type=float, default=0, help="seconds the server waits before each response")
+    parser.add_argument('--max_concurrency', type=int, default=8, help="simultaneous connections to the server")
+    args = parser.parse_args()
+
+    # import dependencies up front so their modules aren't counted as memory used by redrum
+    import requests
+    try:
+        import numpy
+    except ImportError:
+        pass
+
+    print("{:<18}".format("megabytes") + "".join("{:>12}".format(size) for size in args.sizes))
+    columns = []
+    for size in args.sizes:
+        port = free_port()
+        server = start_server(args, pages_for(args, size), port)
+        try:
+            columns.append(run(args, size, port))
+        finally:
+            server.kill()
+            server.wait()
+
+    print("{:<18}".format("images") + "".join("{:>12}".format(length) for length, _ in columns))
+    for row in columns[0][1]:
+        print("{:<18}".format(row) + "".join("{:>12.1f}".format(rows[row]) for _, rows in columns))
+
+
+if __name__ == '__main__':
+    main()
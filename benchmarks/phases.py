@@ -0,0 +1,176 @@
+#!/bin/env python3
+## Per-phase benchmark for redrum against a local fake Imgur API
+## Times each stage of indexing, album expansion, filtering and scoring, a whole streaming refresh,
+##   index building, selection and cache save/load for galleries of roughly 1k, 10k and 100k images
+
+## examples:
+##   python benchmarks/phases.py                          # 1k, 10k and 100k images
+##   python benchmarks/phases.py --sizes 10000 --latency 0.02 --album_ratio 0.3
+##   python benchmarks/phases.py --subreddits 50 --repeat 5
+
+import argparse
+import contextlib
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from redrum import redrum
+
+PHASES = ['index', 'albums', 'filter', 'dedup', 'score', 'reindex', 'refresh', 'build', 'select',
+          'save json', 'load json', 'save binary', 'load binary']
+# wallpapers to pick when timing selection
+SELECTIONS = 100
+
+config_template = """[redrum]
+screen_width = 1920
+screen_height = 1080
+subreddits = {subreddits}
+max_pages = {pages}
+url = {url}
+album_url = {album_url}
+cache_file = {directory}/cache
+image_file = {directory}/image
+max_concurrency = {max_concurrency}
+"""
+
+
+# find a free local port for the fake imgur server
+def free_port():
+    with contextlib.closing(socket.socket()) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+# start fake imgur in its own process so it doesn't compete with redrum for the GIL
+def start_server(args, pages, port):
+    server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fake_imgur.py'),
+                               '--port', str(port), '--pages', str(pages), '--page_size', str(args.page_size),
+                               '--album_ratio', str(args.album_ratio), '--album_size', str(args.album_size),
+                               '--latency', str(args.latency), '--duplicate_ratio', str(args.duplicate_ratio)],
+                              stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return server
+        except socket.error:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("Fake Imgur server did not start")
+
+
+# pages per subreddit needed for about `size` images
+# a result is kept unless deleted (1 in 8) or nsfw (1 in 20), and albums hold `album_size` images
+def pages_for(args, size):
+    per_result = (1 - args.album_ratio) + args.album_ratio * args.album_size
+    per_page = args.page_size * per_result * 7 / 8 * 0.95
+    return max(1, int(round(size / (per_page * args.subreddits))))
+
+
+def timed(times, phase, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    times[phase] = time.perf_counter() - start
+    return result
+
+
+# run every phase of a refresh and a wallpaper change once
+def run(args, size, port):
+    times = {}
+    with tempfile.TemporaryDirectory() as directory:
+        config_path = os.path.join(directory, 'redrum.ini')
+        url = 'http://127.0.0.1:{0}'.format(port)
+        with open(config_path, 'w') as f:
+            f.write(config_template.format(
+                directory=directory,
+                subreddits='\n    '.join('sub{0}'.format(i) for i in range(args.subreddits)),
+                pages=pages_for(args, size),
+                url=url + '/3/gallery/r/{0}/top/all/{1}',
+                album_url=url + '/3/album/{0}',
+                max_concurrency=args.max_concurrency))
+        config = redrum.Config(config_path)
+
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            # run each stage of the ingestion pipeline to completion before the next one
+            albums = {}
+            ingest = redrum.Ingest(config, albums)
+            pages = timed(times, 'index', lambda: list(ingest.pages()))
+            pages = timed(times, 'albums', lambda: list(ingest.expand(pages)))
+            pages = timed(times, 'filter', lambda: list(ingest.filter(pages)))
+            pages = timed(times, 'dedup', lambda: list(ingest.dedup(pages)))
+            ingest.finish()
+            redrum.Checkpoint.remove(config)
+            images = [image for page in pages for image in page]
+            scores = timed(times, 'score', redrum.get_scores, config, images)
+
+            # pages are unchanged, so this measures conditional requests
+            ingest = redrum.Ingest(config, albums)
+            timed(times, 'reindex', lambda: list(ingest.pages()))
+            ingest.finish()
+            redrum.Checkpoint.remove(config)
+
+            # the whole pipeline streaming from a cold start
+            os.remove(config.page_cache_file)
+            timed(times, 'refresh', redrum.refresh, config)
+            seen = redrum.Seen()
+            indexes = timed(times, 'build', redrum.build_indexes, config, images, scores, seen)
+
+            start = time.perf_counter()
+            for _ in range(SELECTIONS):
+                position = redrum.weighted_select(config, images, scores[0], seen, indexes[0])
+                seen.add(images[position]['id'], position)
+                redrum.mark_seen(indexes, scores, position)
+            times['select'] = (time.perf_counter() - start) / SELECTIONS
+
+            date = datetime.now().strftime(config.date_format)
+            for cache_format in ['json', 'binary']:
+                config.cache_format = cache_format
+                timed(times, 'save ' + cache_format, redrum.save, config, images, scores, indexes, date, seen)
+                timed(times, 'load ' + cache_format, redrum.load_state, config)
+
+    return len(images), times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark each phase of redrum against a local fake Imgur API.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="approximate number of images")
+    parser.add_argument('--subreddits', type=int, default=10, help="number of subreddits")
+    parser.add_argument('--page_size', type=int, default=60, help="results per page")
+    parser.add_argument('--album_ratio', type=float, default=0.1, help="fraction of results which are albums")
+    parser.add_argument('--album_size', type=int, default=5, help="images per album")
+    parser.add_argument('--duplicate_ratio', type=float, default=0, help="fraction of results which are cross-posts shared with other subreddits")
+    parser.add_argument('--latency', type=float, default=0, help="seconds the server waits before each response")
+    parser.add_argument('--max_concurrency', type=int, default=8, help="simultaneous connections to the server")
+    parser.add_argument('--repeat', type=int, default=1, help="runs per size, the median is reported")
+    args = parser.parse_args()
+
+    # import numpy up front so the first scoring phase isn't charged for it
+    try:
+        import numpy
+    except ImportError:
+        pass
+
+    print("{:<12}".format("phase (ms)") + "".join("{:>12}".format(size) for size in args.sizes))
+    columns = []
+    for size in args.sizes:
+        port = free_port()
+        server = start_server(args, pages_for(args, size), port)
+        try:
+            runs = [run(args, size, port) for _ in range(args.repeat)]
+        finally:
+            server.kill()
+            server.wait()
+        columns.append((runs[0][0], {phase: statistics.median(times[phase] for _, times in runs) for phase in PHASES}))
+
+    print("{:<12}".format("images") + "".join("{:>12}".format(length) for length, _ in columns))
+    for phase in PHASES:
+        print("{:<12}".format(phase) + "".join("{:>12.3f}".format(times[phase] * 1000) for _, times in columns))
+
+
+if __name__ == '__main__':
+    main()
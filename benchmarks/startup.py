@@ -0,0 +1,97 @@
+#!/bin/env python3
+## Startup time benchmark for redrum
+## Measures wall time from process start to `wallpaper_command` invocation
+##   when the cache is fresh and the selected image is already in the image cache
+
+## examples:
+##   python benchmarks/startup.py                    # 1k, 10k and 100k images, json and binary caches
+##   python benchmarks/startup.py --sizes 100000 --formats binary --repeat 10
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from redrum import redrum
+
+# number of images with a nonzero score, which are put in the image cache
+CANDIDATES = 50
+
+config_template = """[redrum]
+screen_width = 1920
+screen_height = 1080
+subreddits = earthporn
+unseen_only = False
+cache_file = {directory}/cache
+cache_format = {cache_format}
+image_file = {directory}/image
+image_cache_dir = {directory}/images
+image_cache_size = 100
+wallpaper_command = date +%%s.%%N >> {directory}/invoked
+"""
+
+
+# write a config and a fresh cache with `size` synthetic images
+def make_cache(directory, size, cache_format):
+    config_path = os.path.join(directory, 'redrum.ini')
+    with open(config_path, 'w') as f:
+        f.write(config_template.format(directory=directory, cache_format=cache_format))
+    config = redrum.Config(config_path)
+
+    images = [{'id': 'img{0}'.format(i),
+               'link': 'https://i.imgur.com/img{0}.jpg'.format(i),
+               'width': 1920 + i % 1000,
+               'height': 1080 + i % 700,
+               'views': i,
+               'nsfw': False,
+               'subreddit': 'earthporn'} for i in range(size)]
+    # only a few images can be selected, so they can all be put in the image cache
+    scores = [[1.0 if i < CANDIDATES else 0.0 for i in range(size)]]
+    indexes = redrum.build_indexes(config, images, scores, redrum.Seen())
+    date = datetime.now().strftime(config.date_format)
+    redrum.save(config, images, scores, indexes, date, redrum.Seen())
+
+    image_cache = redrum.ImageCache(config)
+    for image in images[:CANDIDATES]:
+        with open(image_cache.path(image['id']), 'wb') as f:
+            f.write(b'\0' * 1024)
+
+    return config_path
+
+
+# time one run of redrum from process start to `wallpaper_command`
+def run(directory, config_path):
+    invoked = os.path.join(directory, 'invoked')
+    if os.path.exists(invoked):
+        os.remove(invoked)
+    start = time.time()
+    subprocess.check_call([sys.executable, '-m', 'redrum.redrum', '--config', config_path],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                          cwd=os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+    with open(invoked, 'r') as f:
+        return float(f.read().split()[0]) - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark redrum startup time on a fresh cache.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="number of images in the cache")
+    parser.add_argument('--formats', nargs='+', default=['json', 'binary'], help="cache formats to benchmark")
+    parser.add_argument('--repeat', type=int, default=5, help="runs per measurement")
+    args = parser.parse_args()
+
+    print("{:<8} {:>8} {:>12} {:>12}".format("format", "images", "median (ms)", "min (ms)"))
+    for cache_format in args.formats:
+        for size in args.sizes:
+            with tempfile.TemporaryDirectory() as directory:
+                config_path = make_cache(directory, size, cache_format)
+                times = [run(directory, config_path) * 1000 for _ in range(args.repeat)]
+            print("{:<8} {:>8} {:>12.1f} {:>12.1f}".format(cache_format, size, statistics.median(times), min(times)))
+
+
+if __name__ == '__main__':
+    main()
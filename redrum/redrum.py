@@ -12,15 +12,20 @@ import sys
 # if sys.version_info[0] < 3:
 #     sys.exit("redrum must be run in python3 (or installed through pip3.)")
 
-import requests
-from requests.exceptions import ConnectionError
 import logging
 import random, math
 import os, shutil
 import subprocess
+import shlex
 import json
+import signal
+import threading
+import time
 import argparse
+import contextlib
+import collections
 from .version import __version__
+from . import snapshot
 from datetime import datetime, timedelta
 from configparser import SafeConfigParser
 
@@ -29,28 +34,151 @@ logger = logging.getLogger(__name__)
 # hide annoying requests messages
 logging.getLogger("requests").setLevel(logging.WARNING)
 
+# requests and numpy are slow to import, so they are only imported when needed
+#   and runs which only select an image from the cache start quickly
+
+# fields kept for images inside expanded albums, stored as rows of values in this order
+ALBUM_FIELDS = ['id', 'link', 'width', 'height', 'views', 'nsfw']
+# fields kept for images and albums on gallery pages, stored as rows of values in this order
+PAGE_FIELDS = ALBUM_FIELDS + ['is_album', 'subreddit']
+PageResult = collections.namedtuple('PageResult', PAGE_FIELDS)
+# fields of indexed images, which are also sent by an index server, see `serve`
+IMAGE_FIELDS = ALBUM_FIELDS + ['subreddit', 'subreddits']
+
+
+# indexed image holding only the fields redrum uses, in a fraction of the memory of a dict
+# fields are read and written like a dict's, so dicts decoded from a json cache or a snapshot are used the same way
+class ImageRecord(object):
+    __slots__ = IMAGE_FIELDS
+
+    def __init__(self, id, link, width, height, views, nsfw, subreddit=None, subreddits=None):
+        self.id = id
+        self.link = link
+        self.width = width
+        self.height = height
+        self.views = views
+        self.nsfw = nsfw
+        # there are only a few subreddits, so every image shares their names
+        self.subreddit = sys.intern(subreddit) if subreddit else subreddit
+        self.subreddits = [sys.intern(name) for name in subreddits or []]
+
+    # image from a dict, where caches written before images were slimmed hold other fields too
+    @classmethod
+    def from_json(cls, j):
+        return cls(*[j.get(field) for field in IMAGE_FIELDS])
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field)
+
+    def __setitem__(self, field, value):
+        setattr(self, field, value)
+
+    def get(self, field, default=None):
+        return getattr(self, field, default)
+
+    # lets `dict(image)` and json serialization treat images as dicts
+    def keys(self):
+        return IMAGE_FIELDS
+
+
+# wall time of each phase of a run and counters for requests, caches and filtering
+# shown with `--stats` and appended to `metrics_file` as json lines
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.date = datetime.now()
+            self.times = {}
+            self.counts = {}
+
+    # time a phase, adding to earlier runs of the same phase
+    # stats may be reset while a phase runs in another thread, such as the daemon's background refresh
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.times[name] = self.times.get(name, 0) + time.time() - start
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+    # copy of the date, times and counters, as another thread may add to them while they're reported
+    def snapshot(self):
+        with self.lock:
+            return self.date, dict(self.times), dict(self.counts)
+
+    # fraction of hits for counters named `<cache>_hits` and `<cache>_misses`
+    @staticmethod
+    def hit_rates(counts):
+        caches = set(name.rsplit('_', 1)[0] for name in counts
+                     if name.endswith('_hits') or name.endswith('_misses'))
+        rates = {}
+        for cache in caches:
+            hits = counts.get(cache + '_hits', 0)
+            total = hits + counts.get(cache + '_misses', 0)
+            if total:
+                rates[cache] = hits / total
+        return rates
+
+    def report(self):
+        _, times, counts = self.snapshot()
+        print("Phase times:")
+        for name, seconds in times.items():
+            print("  {0:<20} {1:>10.1f} ms".format(name, seconds * 1000))
+        print("Counters:")
+        for name, amount in sorted(counts.items()):
+            print("  {0:<20} {1:>10}".format(name, amount))
+        for cache, rate in sorted(self.hit_rates(counts).items()):
+            print("  {0:<20} {1:>9.1f}% hits".format(cache, rate * 100))
+
+    # append stats as a json line so they can be graphed over time
+    def write(self, path):
+        date, times, counts = self.snapshot()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a') as f:
+            f.write(json.dumps({'date': date.isoformat(),
+                                'times': times,
+                                'counts': counts,
+                                'hit_rates': self.hit_rates(counts)}) + '\n')
+
+stats = Stats()
+
 
 
 def logistic_function(x, midpoint, k):
     return (1 + pow(math.e, -k * (1 - midpoint))) / (1 + pow(math.e, -k * (x - midpoint)))
 
 # calculate a score for an image
-def score_image(config, image, max_views):
+# `screen` is a [width, height] pair, defaulting to `screen_width` and `screen_height`
+def score_image(config, image, max_views, screen=None):
+    screen_width, screen_height = screen or (config.screen_width, config.screen_height)
+    screen_ratio = float(screen_width) / screen_height
+
     # score image ratio match from 0-1
     # calculates quotient of ratio.  the closer to 1, the better the match
     image_ratio = float(image['width']) / image['height']
-    if config.screen_ratio < image_ratio:
-        ratio_score = config.screen_ratio / image_ratio
+    if screen_ratio < image_ratio:
+        ratio_score = screen_ratio / image_ratio
     else:
-        ratio_score = image_ratio / config.screen_ratio
+        ratio_score = image_ratio / screen_ratio
 
     # score total views from 0-1
     views_score = float(image['views']) / max_views
 
     # score image pixels from 0-1
     # don't give any extra weight to images greater than our screen size
-    width_score = float(image['width']) / config.screen_width
-    height_score = float(image['height']) / config.screen_height
+    width_score = float(image['width']) / screen_width
+    height_score = float(image['height']) / screen_height
     if width_score > 1:
         width_score = 1
     if height_score > 1:
@@ -73,151 +201,1237 @@ def score_image(config, image, max_views):
             views_logistic_score,
             pixel_logistic_score]
 
-# get list of image and album metadata from each subreddit
-def get_images(config):
+# create a keep-alive session shared by all indexing threads
+def get_session(config):
+    import requests
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=config.max_concurrency,
+                                            pool_maxsize=config.max_concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update(config.headers)
+    return session
+
+# raised when imgur's remaining request quota drops to `quota_reserve`
+class QuotaExhausted(Exception):
+    pass
+
+# schedules requests to the imgur api according to the rate limit headers on its responses
+# concurrency and pacing are reduced as the remaining quota runs low, failed requests are
+#   retried with exponential backoff and no more requests are made once the quota is exhausted
+class RequestScheduler(object):
+    def __init__(self, config, session):
+        self.config = config
+        self.session = session
+        self.condition = threading.Condition()
+        self.active = 0
+        self.next_request = 0
+        # lowest of the client and user quota remaining, and when the user quota resets
+        self.remaining = None
+        self.reset = None
+        self.exhausted = False
+
+    # number of requests allowed at once, scaled down once fewer than `quota_slowdown` spare requests remain
+    def concurrency(self):
+        if self.remaining is None:
+            return self.config.max_concurrency
+        spare = self.remaining - self.config.quota_reserve
+        return max(1, min(self.config.max_concurrency, spare * self.config.max_concurrency // self.config.quota_slowdown))
+
+    # seconds between requests, spreading the spare quota until it resets once it runs low
+    def interval(self):
+        if self.remaining is None:
+            return 0
+        spare = self.remaining - self.config.quota_reserve
+        if spare >= self.config.quota_slowdown:
+            return 0
+        if self.reset is None:
+            return self.config.retry_delay
+        return min(self.config.max_request_interval, max(0, self.reset - time.time()) / max(spare, 1))
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.concurrency() and not self.exhausted:
+                self.condition.wait()
+            if self.exhausted:
+                raise QuotaExhausted()
+            self.active += 1
+            delay = self.next_request - time.time()
+            self.next_request = max(time.time(), self.next_request) + self.interval()
+        if delay > 0:
+            time.sleep(delay)
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    # track remaining quota from response headers
+    def update(self, headers):
+        remaining = [int(headers[header]) for header in ('X-RateLimit-ClientRemaining', 'X-RateLimit-UserRemaining')
+                     if headers.get(header, '').isdigit()]
+        with self.condition:
+            if remaining:
+                self.remaining = min(remaining)
+                if self.remaining <= self.config.quota_reserve and not self.exhausted:
+                    logger.error("Imgur request quota exhausted ({0} requests remaining)".format(self.remaining))
+                    self.exhausted = True
+            if headers.get('X-RateLimit-UserReset', '').isdigit():
+                self.reset = int(headers['X-RateLimit-UserReset'])
+            self.condition.notify_all()
+
+    # make a GET request, retrying connection errors, rate limiting and server errors
+    def get(self, url, **kwargs):
+        from requests.exceptions import ConnectionError, Timeout
+
+        for attempt in range(self.config.max_retries + 1):
+            self.acquire()
+            stats.count('requests')
+            try:
+                response = self.session.get(url, timeout=self.config.timeout, **kwargs)
+            except (ConnectionError, Timeout) as e:
+                response = None
+                error = e
+            finally:
+                self.release()
+
+            if response is not None:
+                stats.count('bytes', len(response.content))
+                self.update(response.headers)
+                if response.status_code != 429 and response.status_code < 500:
+                    return response
+                error = "HTTP {0}".format(response.status_code)
+
+            if attempt < self.config.max_retries:
+                delay = self.config.retry_delay * 2 ** attempt
+                stats.count('retries')
+                logger.debug("Request to {0} failed ({1}), retrying in {2}s".format(url, error, delay))
+                time.sleep(delay)
+
+        logger.error("Request to {0} failed after {1} attempts ({2})".format(url, attempt + 1, error))
+        if response is None:
+            raise error
+        return response
+
+# get the json from an imgur api response, turning non-json error pages into imgur style errors
+def response_json(response):
+    try:
+        return response.json()
+    except ValueError:
+        return {'success': False, 'data': {'error': "HTTP {0}".format(response.status_code)}}
+
+# calculate scores for many images at once
+# returns the same seven score columns as `score_image`, as numpy arrays if numpy is installed
+# if a list of `screens` is given, every column except the two views scores has a row of scores for each screen
+def score_images(config, widths, heights, views, max_views=None, screens=None):
+    if max_views is None:
+        max_views = max(views)
+
+    # numpy is optional, but makes scoring large caches much faster
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+
+    # fall back to scoring each image individually
+    if np is None:
+        def score_screen(screen):
+            scores = [score_image(config, {'width': width, 'height': height, 'views': image_views}, max_views, screen)
+                      for width, height, image_views in zip(widths, heights, views)]
+            return [list(column) for column in zip(*scores)] or [[] for _ in range(7)]
+
+        if screens is None:
+            return score_screen(None)
+        columns = [list(column) for column in zip(*[score_screen(screen) for screen in screens])]
+        # views don't depend on the screen
+        columns[2], columns[5] = columns[2][0], columns[5][0]
+        return columns
+
+    widths = np.asarray(widths, dtype=float)
+    heights = np.asarray(heights, dtype=float)
+    views = np.asarray(views, dtype=float)
+
+    # screens are broadcast along a first axis to score all of them in one pass
+    if screens is None:
+        screen_width, screen_height = float(config.screen_width), float(config.screen_height)
+    else:
+        screen_width = np.array([[screen[0]] for screen in screens], dtype=float)
+        screen_height = np.array([[screen[1]] for screen in screens], dtype=float)
+    screen_ratio = screen_width / screen_height
 
-    # get results for each subreddit
-    results = []
-    for subreddit in config.subreddits:
-        # keep getting results on each subreddit album until there are none left
-        page_num = 0
-        while page_num < config.max_pages:
-            page_url = config.url.format(subreddit, page_num)
-            print("Indexing page {0} from subreddit {1}\r".format(', '.join(map(str, range(page_num + 1))), subreddit), end="")
-            response = requests.get(page_url, headers=config.headers).json()
+    # score image ratio match from 0-1
+    image_ratio = widths / heights
+    ratio_score = np.where(screen_ratio < image_ratio,
+                           screen_ratio / image_ratio,
+                           image_ratio / screen_ratio)
 
-            if response['success'] == True:
-                # tag all images with their subreddit
-                for result in response['data']:
-                    result['subreddit'] = subreddit
-                page_results = response['data']
-                page_num += 1
+    # score total views from 0-1
+    views_score = views / max_views
 
-                # once we hit the last page, break
-                if len(page_results) == 0:
-                    break
+    # score image pixels from 0-1
+    pixel_score = (np.minimum(widths / screen_width, 1) *
+                   np.minimum(heights / screen_height, 1))
 
-                results += page_results
+    # run the scores through logistic function
+    ratio_logistic_score = logistic_function(ratio_score, config.ratio_midpoint, config.ratio_k)
+    views_logistic_score = logistic_function(views_score, config.views_midpoint, config.views_k)
+    pixel_logistic_score = logistic_function(pixel_score, config.pixel_midpoint, config.pixel_k)
 
-            else:
-                logging.error("Received error from Imgur: {0}".format(response['data']['error']))
-
-        if page_num == 0:
-            logging.error("No results found for subreddit {0}.".format(subreddit))
-        print()
-
-    # clean list of images and albums
-    def check_results(results, in_album=False):
-        for result in results or []:
-            logger.debug(result)
-            # if result is an album, append its images to `images`
-            if not in_album and result['is_album']:
-                album_id = result['id']
-                logging.debug("Unpacking album {0}".format(album_id))
-                response = requests.get(config.album_url.format(album_id), headers=config.headers).json()
-                if response['success'] == True:
-                    album_results = response['data']
-                    check_results(album_results['images'], in_album = True)
-                else:
-                    logging.error("Received error from Imgur: {0}".format(response['data']['error']))
+    final_score = ratio_logistic_score * views_logistic_score * pixel_logistic_score
 
-            # remove zero pixel (deleted) images
-            elif (result['width'] == 0 or result['height'] == 0):
-                continue
+    return [final_score,
+            ratio_score,
+            views_score,
+            pixel_score,
+            ratio_logistic_score,
+            views_logistic_score,
+            pixel_logistic_score]
 
-            # remove NSFW
-            elif config.sfw_only and result['nsfw'] == True:
-                continue
+# check whether an image should be kept, removing deleted and NSFW images
+def keep_image(config, image):
+    # remove zero pixel (deleted) images
+    if image['width'] == 0 or image['height'] == 0:
+        stats.count('filtered_deleted')
+        return False
+    # remove NSFW
+    if config.sfw_only and image['nsfw'] == True:
+        stats.count('filtered_nsfw')
+        return False
+    return True
+
+# persistent per-url cache of gallery pages
+# pages are requested conditionally, so unchanged pages are neither downloaded nor filtered again
+class PageCache(object):
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.pages = {}
+        self.used = set()
+        self.saved_pages = 0
+        self.saved_bytes = 0
+        if os.path.exists(config.page_cache_file):
+            with open(config.page_cache_file, 'r') as f:
+                j = json.loads(f.read())
+            # stored pages are already filtered, so they can't be reused if `sfw_only` changed
+            if j['sfw_only'] == config.sfw_only and j.get('fields') == PAGE_FIELDS:
+                self.pages = j['pages']
+
+    # get a gallery page as an imgur response with results tagged with `subreddit` and filtered
+    # results are projected into rows of `PAGE_FIELDS` right away, so other fields aren't kept
+    # `empty` is set on the response if the page had no results before filtering
+    def get(self, session, url, subreddit):
+        page = self.pages.get(url)
+        headers = {}
+        if page is not None:
+            if page['etag']:
+                headers['If-None-Match'] = page['etag']
+            if page['last_modified']:
+                headers['If-Modified-Since'] = page['last_modified']
+
+        response = session.get(url, headers=headers)
+        self.used.add(url)
+        if response.status_code == 304 and page is not None:
+            stats.count('page_cache_hits')
+            with self.lock:
+                self.saved_pages += 1
+                self.saved_bytes += page['bytes']
+            return {'success': True, 'data': page['data'], 'empty': page['empty']}
+
+        stats.count('page_cache_misses')
+        j = response_json(response)
+        if j['success'] == True:
+            data = []
+            for result in j['data']:
+                # tag all images with their subreddit
+                result['subreddit'] = subreddit
+                if result['is_album'] or keep_image(self.config, result):
+                    data.append([result.get(field) for field in PAGE_FIELDS])
+            page = {'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'bytes': len(response.content),
+                    'data': data,
+                    'empty': len(j['data']) == 0}
+            # only pages with validators can be requested conditionally
+            if page['etag'] or page['last_modified']:
+                self.pages[url] = page
+            return {'success': True, 'data': data, 'empty': page['empty']}
+
+        return j
+
+    # save pages requested during this refresh
+    # pages a partial refresh didn't reach are kept too, so the refresh resuming it can still request them conditionally
+    def save(self, complete=True):
+        pages = {url: page for url, page in self.pages.items() if url in self.used or not complete}
+        os.makedirs(os.path.dirname(self.config.page_cache_file), exist_ok=True)
+        with open(self.config.page_cache_file + '.tmp', 'w') as f:
+            f.write(json.dumps({'sfw_only': self.config.sfw_only, 'fields': PAGE_FIELDS, 'pages': pages}))
+        os.replace(self.config.page_cache_file + '.tmp', self.config.page_cache_file)
+
+# progress of a refresh, appended to `checkpoint_file` as json lines as each page and album arrives
+# a refresh which was interrupted or failed resumes from it without requesting those pages and albums again
+# the checkpoint is removed once the refreshed cache is saved
+class Checkpoint(object):
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.pages = {}
+        self.albums = {}
+        self.resumed_pages = 0
+
+        header = None
+        if os.path.exists(config.checkpoint_file):
+            with open(config.checkpoint_file, 'r') as f:
+                for line in f:
+                    # skip lines left incomplete by a crash
+                    if not line.endswith('\n'):
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if header is None:
+                        header = record
+                    elif 'page' in record:
+                        self.pages[record['page']] = {'success': True, 'data': record['data'], 'empty': record['empty']}
+                    elif 'album' in record:
+                        self.albums[record['album']] = record['images']
+
+        # a checkpoint is only resumed by the same kind of refresh, and only while its pages are fresh
+        if (header is None or header.get('fetch_options') != config.fetch_options or
+                header.get('fields') != PAGE_FIELDS or
+                time.time() - header['started'] > config.cache_expiry.total_seconds()):
+            self.pages = {}
+            self.albums = {}
+            header = {'fetch_options': config.fetch_options, 'fields': PAGE_FIELDS, 'started': int(time.time())}
+            os.makedirs(os.path.dirname(config.checkpoint_file), exist_ok=True)
+            with open(config.checkpoint_file, 'w') as f:
+                f.write(json.dumps(header) + '\n')
+        elif self.pages or self.albums:
+            print("Resuming refresh with {0} pages and {1} albums already fetched".format(len(self.pages), len(self.albums)))
+        self.file = open(config.checkpoint_file, 'a')
+
+    def write(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+
+    # get a page fetched by an earlier attempt, or None
+    def page(self, url):
+        page = self.pages.get(url)
+        if page is not None:
+            stats.count('resumed_pages')
+            with self.lock:
+                self.resumed_pages += 1
+        return page
+
+    def add_page(self, url, page):
+        self.write({'page': url, 'data': page['data'], 'empty': page['empty']})
+
+    def add_album(self, album_id, images):
+        self.write({'album': album_id, 'images': images})
+
+    # record that this attempt couldn't fetch everything, so the previous cache is used for a while
+    def fail(self):
+        self.write({'failed': int(time.time()), 'fetch_options': self.config.fetch_options})
+
+    def close(self):
+        self.file.close()
+
+    # time of the last failed refresh with the current fetch options, or None
+    # only the end of the checkpoint is read, since a failure is the last record written
+    @staticmethod
+    def last_failure(config):
+        try:
+            with open(config.checkpoint_file, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                f.seek(max(0, f.tell() - 4096))
+                lines = f.read().decode('utf-8', 'ignore').split('\n')
+        except (IOError, OSError):
+            return None
+        try:
+            record = json.loads(lines[-2]) if len(lines) > 1 else {}
+        except ValueError:
+            return None
+        if 'failed' in record and record['fetch_options'] == config.fetch_options:
+            return record['failed']
+
+    @staticmethod
+    def remove(config):
+        if os.path.exists(config.checkpoint_file):
+            os.remove(config.checkpoint_file)
+
+# get image and album metadata from a single subreddit, yielding the results of each page
+# pages in `checkpoint` are used without requesting them, and newly fetched pages are added to it
+# returns whether every page could be fetched
+def get_subreddit(config, session, page_cache, checkpoint, subreddit):
+    from requests.exceptions import RequestException
+
+    # keep getting results on each subreddit album until there are none left
+    page_num = 0
+    while page_num < config.max_pages:
+        page_url = config.url.format(subreddit, page_num)
+        logger.debug("Indexing page {0} from subreddit {1}".format(page_num, subreddit))
+        response = checkpoint.page(page_url)
+        if response is not None:
+            # keep validators of resumed pages in the page cache
+            page_cache.used.add(page_url)
+        else:
+            try:
+                response = page_cache.get(session, page_url, subreddit)
+            except (QuotaExhausted, RequestException):
+                return False
+            if response['success'] == True:
+                checkpoint.add_page(page_url, response)
 
-            # else, append image
-            else:
-                images.append(result)
+        if response['success'] == True:
+            page_num += 1
 
-    # build list of images, replacing albums with images they contain
-    print("Filtering results...")
-    images = []
-    check_results(results)
+            # once we hit the last page, break
+            if response['empty']:
+                break
 
-    # make sure we actually got results
-    if len(images) == 0:
-        print("No results found")
-        sys.exit()
+            yield response['data']
 
-    # score each image based on parameters
-    # higher score is better
-    print("Scoring {} images".format(len(images)))
-    max_views = max([image['views'] for image in images])
-    for image in images:
+        # give up on this subreddit rather than retrying the same page forever
+        else:
+            logger.error("Received error from Imgur: {0}".format(response['data']['error']))
+            return False
 
-        # Calculate final image score from presets.
-        image['redrum_score'] = score_image(config, image, max_views)[0]
+    if page_num == 0:
+        logger.error("No results found for subreddit {0}.".format(subreddit))
 
-    return images
+    return True
 
+# get list of images contained in an album
+def get_album(config, session, album_id):
+    from requests.exceptions import RequestException
 
-# select a random image weighted by score
-def weighted_select(config, images, seen):
-    # if unseen_only is true, only look at at unseen images
-    if config.unseen_only:
-        images = [image for image in images if image['id'] not in seen]
+    logger.debug("Unpacking album {0}".format(album_id))
+    try:
+        response = response_json(session.get(config.album_url.format(album_id)))
+    except (QuotaExhausted, RequestException):
+        return None
+    if response['success'] == True:
+        return response['data']['images']
+    else:
+        logger.error("Received error from Imgur: {0}".format(response['data']['error']))
+
+# streaming pipeline which indexes subreddits, expands albums, filters, deduplicates and scores images page by page,
+#   so images can be used before indexing is finished and raw results are never all held at once
+# each stage is a generator of lists, one for each page
+# `albums` maps album ids to their images and is updated with newly expanded albums
+class Ingest(object):
+    def __init__(self, config, albums):
+        self.config = config
+        self.albums = albums
+        self.session = RequestScheduler(config, get_session(config))
+        self.page_cache = PageCache(config)
+        # albums expanded by an interrupted attempt count as expanded in an earlier refresh
+        self.checkpoint = Checkpoint(config)
+        albums.update(self.checkpoint.albums)
+        # albums found while indexing
+        self.album_ids = set()
+        # images indexed so far by id and by link, how many there are and how many copies were dropped
+        self.unique = {}
+        self.unique_count = 0
+        self.duplicates = 0
+        # highest views of images scored so far
+        self.max_views = 0
+        # whether scores were computed before `max_views` was known
+        self.provisional = False
+        self.complete = True
+
+    # yield pages of results from each subreddit in turn, in the order of `subreddits`, so the first copy of a
+    #   duplicate is the same however fast each subreddit is indexed
+    # subreddits are indexed concurrently, and indexing of a subreddit pauses while `max_concurrency` of its pages
+    #   wait to be expanded
+    def pages(self):
+        import queue
+        from concurrent.futures import ThreadPoolExecutor
+
+        subreddit_pages = [queue.Queue(maxsize=self.config.max_concurrency) for _ in self.config.subreddits]
+        done = object()
+        stop = threading.Event()
+
+        def index(subreddit, pages):
+            indexed = 0
+            try:
+                results = get_subreddit(self.config, self.session, self.page_cache, self.checkpoint, subreddit)
+                while not stop.is_set():
+                    try:
+                        page = next(results)
+                    except StopIteration as e:
+                        if not e.value:
+                            self.complete = False
+                        break
+                    indexed += len(page)
+                    pages.put(page)
+                print("Indexed {0} results from subreddit {1}".format(indexed, subreddit))
+            finally:
+                pages.put(done)
+
+        # subreddits start in order, so the subreddit being yielded has always started and can't be
+        #   blocked behind later subreddits waiting for their pages to be taken
+        with ThreadPoolExecutor(max_workers=self.config.max_concurrency) as executor:
+            futures = [executor.submit(index, subreddit, pages)
+                       for subreddit, pages in zip(self.config.subreddits, subreddit_pages)]
+            remaining = list(subreddit_pages)
+            try:
+                while remaining:
+                    with stats.phase('index'):
+                        page = remaining[0].get()
+                    if page is done:
+                        remaining.pop(0)
+                    else:
+                        yield page
+            # if the pipeline is closed early, unblock indexing threads so they can stop
+            finally:
+                stop.set()
+                for pages in remaining:
+                    while pages.get() is not done:
+                        pass
+            for future in futures:
+                future.result()
+
+    # replace albums in each page with the images they contain, turning rows of results into `ImageRecord`s
+    # only albums not expanded in an earlier refresh are fetched, and albums of up to `max_concurrency`
+    #   pages are fetched at once so that pages with few albums don't leave connections idle
+    def expand(self, pages):
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
+
+        # albums being fetched, and pages waiting for their albums in the order they arrived
+        fetching = {}
+        waiting = deque()
+
+        def expanded(page, futures):
+            for album_id, future in futures.items():
+                fetching.pop(album_id, None)
+                album_images = future.result()
+                if album_images is not None and album_id not in self.albums:
+                    self.albums[album_id] = [[image.get(field) for field in ALBUM_FIELDS] for image in album_images]
+                    self.checkpoint.add_album(album_id, self.albums[album_id])
+            results = []
+            for result in page:
+                if result.is_album:
+                    # album images come from the album's subreddit
+                    results += [ImageRecord(*row, subreddit=result.subreddit) for row in self.albums.get(result.id, [])]
+                else:
+                    results.append(ImageRecord(*result[:len(ALBUM_FIELDS)], subreddit=result.subreddit))
+            return results
+
+        with ThreadPoolExecutor(max_workers=self.config.max_concurrency) as executor:
+            pages = iter(pages)
+            while True:
+                page = next(pages, None)
+                with stats.phase('albums'):
+                    if page is not None:
+                        page = [PageResult._make(row) for row in page]
+                        album_ids = list(dict.fromkeys(result.id for result in page if result.is_album))
+                        self.album_ids.update(album_ids)
+                        new_album_ids = [album_id for album_id in album_ids if album_id not in self.albums]
+                        stats.count('album_cache_hits', len(album_ids) - len(new_album_ids))
+                        stats.count('album_cache_misses', len(new_album_ids))
+                        for album_id in new_album_ids:
+                            if album_id not in fetching:
+                                fetching[album_id] = executor.submit(get_album, self.config, self.session, album_id)
+                        waiting.append((page, {album_id: fetching[album_id] for album_id in new_album_ids}))
+
+                    # pass pages on in order once their albums are expanded, or once too many are waiting
+                    ready = []
+                    while waiting and (page is None or len(waiting) > self.config.max_concurrency or
+                                       all(future.done() for future in waiting[0][1].values())):
+                        ready.append(expanded(*waiting.popleft()))
+                for results in ready:
+                    yield results
+                if page is None:
+                    break
 
-    if len(images) == 0:
+    # remove deleted and NSFW images
+    def filter(self, pages):
+        for page in pages:
+            with stats.phase('filter'):
+                images = [image for image in page if keep_image(self.config, image)]
+            yield images
+
+    # drop images already indexed under the same id or link, adding their subreddit to the first copy
+    # each image gets the list of `subreddits` it was found in
+    def dedup(self, pages):
+        for page in pages:
+            with stats.phase('dedup'):
+                images = []
+                for image in page:
+                    original = self.unique.get(image['id']) or self.unique.get(image['link'])
+                    if original is None:
+                        image['subreddits'] = [image['subreddit']] if image.get('subreddit') else []
+                        self.unique[image['id']] = self.unique[image['link']] = image
+                        self.unique_count += 1
+                        images.append(image)
+                    else:
+                        self.duplicates += 1
+                        if image.get('subreddit') and image['subreddit'] not in original['subreddits']:
+                            original['subreddits'].append(image['subreddit'])
+            yield images
+
+    # yield images of each page with their scores for each screen
+    # scores are provisional until all images are indexed, since views are scored against the most views so far
+    def score(self, pages):
+        for images in pages:
+            with stats.phase('score'):
+                if images:
+                    views = [image['views'] for image in images]
+                    if self.max_views and max(views) > self.max_views:
+                        self.provisional = True
+                    self.max_views = max(self.max_views, max(views))
+                    scores = score_images(self.config,
+                                          [image['width'] for image in images],
+                                          [image['height'] for image in images],
+                                          views, self.max_views, self.config.screens)[0]
+                    scores = [[float(score) for score in screen_scores] for screen_scores in scores]
+                else:
+                    scores = [[] for screen in self.config.screens]
+            yield images, scores
+
+    # save indexed pages and albums, forgetting albums which are no longer in any subreddit
+    # returns whether the index is complete
+    def finish(self):
+        # albums which couldn't be expanded because of the quota are missing too
+        if self.session.exhausted:
+            self.complete = False
+
+        self.page_cache.save(self.complete)
+        print("Reused {0} unchanged pages, saving {1:.1f} kB of downloads".format(
+            self.page_cache.saved_pages, self.page_cache.saved_bytes / 1024.0))
+        if self.checkpoint.resumed_pages:
+            print("Resumed {0} pages fetched by an earlier attempt".format(self.checkpoint.resumed_pages))
+        if self.duplicates:
+            print("Merged {0} duplicate images, shrinking the index by {1:.1f}% to {2} images".format(
+                self.duplicates, 100.0 * self.duplicates / (self.duplicates + self.unique_count), self.unique_count))
+        stats.count('duplicates', self.duplicates)
+        # albums are only forgotten once every page has been seen, as pages a partial refresh didn't reach
+        #   may still hold them
+        if self.complete:
+            for album_id in set(self.albums) - self.album_ids:
+                del self.albums[album_id]
+        save_albums(self.config, self.albums)
+
+        if not self.complete:
+            print("Only part of the index could be fetched")
+            self.checkpoint.fail()
+        self.checkpoint.close()
+        return self.complete
+
+# score each image based on parameters
+# higher score is better
+# returns a list of scores for each screen
+def get_scores(config, images):
+    print("Scoring {} images for {} screens".format(len(images), len(config.screens)))
+    with stats.phase('score'):
+        final_scores = score_images(config,
+                                    [image['width'] for image in images],
+                                    [image['height'] for image in images],
+                                    [image['views'] for image in images],
+                                    screens=config.screens)[0]
+
+        # Calculate final image score from presets.
+        return [[float(score) for score in screen_scores] for screen_scores in final_scores]
+
+
+# cumulative score index (Fenwick tree) for O(log n) weighted selection
+# if `unseen_only` is set, seen images are given a weight of 0
+class ScoreIndex(object):
+    def __init__(self, tree, candidates, unseen_only):
+        self.tree = tree
+        self.candidates = candidates
+        self.unseen_only = unseen_only
+
+    @classmethod
+    def build(cls, config, images, scores, seen):
+        with stats.phase('build'):
+            weights = [0 if config.unseen_only and image['id'] in seen else score
+                       for image, score in zip(images, scores)]
+            candidates = sum(1 for image in images if not config.unseen_only or image['id'] not in seen)
+
+            # each node holds the sum of the weights below it
+            tree = [0.0] + weights
+            for i in range(1, len(tree)):
+                parent = i + (i & -i)
+                if parent < len(tree):
+                    tree[parent] += tree[i]
+
+            return cls(tree, candidates, config.unseen_only)
+
+    # sum of the weights of all images
+    def total(self):
+        total = 0
+        i = len(self.tree) - 1
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    # add `delta` to the weight of image at `position`
+    def update(self, position, delta):
+        # trees loaded from a binary snapshot are read-only
+        if not isinstance(self.tree, list):
+            self.tree = list(self.tree)
+        i = position + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    # find position of the image whose cumulative weight range contains `value`
+    def find(self, value):
+        position = 0
+        step = 1 << (len(self.tree) - 1).bit_length()
+        while step:
+            if position + step < len(self.tree) and self.tree[position + step] <= value:
+                position += step
+                value -= self.tree[position]
+            step >>= 1
+        return min(position, len(self.tree) - 2)
+
+    # remove a newly seen image from selection
+    def mark_seen(self, position, score):
+        if self.unseen_only:
+            self.update(position, -score)
+            self.candidates -= 1
+
+    # return a forgotten seen image to selection
+    def mark_unseen(self, position, score):
+        if self.unseen_only:
+            self.update(position, score)
+            self.candidates += 1
+
+    def to_json(self):
+        return {'tree': self.tree, 'candidates': self.candidates, 'unseen_only': self.unseen_only}
+
+
+# build a score index for each screen
+def build_indexes(config, images, scores, seen):
+    return [ScoreIndex.build(config, images, screen_scores, seen) for screen_scores in scores]
+
+
+# remove a newly seen image from selection on every screen
+def mark_seen(indexes, scores, position):
+    for index, screen_scores in zip(indexes, scores):
+        index.mark_seen(position, screen_scores[position])
+
+
+def mark_unseen(indexes, scores, position):
+    for index, screen_scores in zip(indexes, scores):
+        index.mark_unseen(position, screen_scores[position])
+
+
+# ids of images which have been set as wallpaper, oldest first
+# each id maps to when it was seen and its position in `images`, so forgetting it is O(log n)
+class Seen(object):
+    def __init__(self, entries=None):
+        self.entries = entries or {}
+
+    # load from a cache, where older caches hold a plain list of ids without times or positions
+    @classmethod
+    def from_json(cls, j):
+        if isinstance(j, list):
+            now = int(time.time())
+            return cls({image_id: [now, None] for image_id in j})
+        return cls(j)
+
+    def to_json(self):
+        return self.entries
+
+    def __contains__(self, image_id):
+        return image_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def add(self, image_id, position, when=None):
+        self.entries.pop(image_id, None)
+        self.entries[image_id] = [int(when or time.time()), position]
+
+    # whether positions are unknown and have to be found with `reindex`
+    def unindexed(self):
+        return any(position is None for when, position in self.entries.values())
+
+    # update positions for a new list of images, forgetting images which are no longer in it
+    # returns the number of images forgotten
+    def reindex(self, images):
+        positions = {image['id']: position for position, image in enumerate(images) if image['id'] in self.entries}
+        forgotten = len(self.entries) - len(positions)
+        self.entries = {image_id: [when, positions[image_id]]
+                        for image_id, (when, position) in self.entries.items() if image_id in positions}
+        return forgotten
+
+    # forget images seen more than `forget_days` ago and all but the newest `max_seen` images
+    # returns the positions of the forgotten images
+    def expire(self, config):
+        expired = []
+        if config.forget_days:
+            cutoff = time.time() - config.forget_days * 24 * 60 * 60
+            expired += [image_id for image_id, (when, position) in self.entries.items() if when < cutoff]
+        if config.max_seen and len(self.entries) > config.max_seen:
+            expired += list(self.entries)[:len(self.entries) - config.max_seen]
+        return [self.entries.pop(image_id)[1] for image_id in dict.fromkeys(expired)]
+
+
+# select a random image weighted by score, returning its position in `images`
+# positions in `exclude` are skipped while there are enough other candidates
+def weighted_select(config, images, scores, seen, index, exclude=()):
+    total_redrum_score = index.total()
+    if index.candidates == 0 or total_redrum_score <= 0:
         print("No images available.  Set `unseen_only` to False, increase `max_pages` or add more subreddits")
         sys.exit()
-
-    total_redrum_score = sum([image['redrum_score'] for image in images])
-    rand_score = random.uniform(0, total_redrum_score)
-    for image in images:
-        rand_score -= image['redrum_score']
-        if rand_score <= 0:
-            break
-
+    if index.candidates <= len(exclude):
+        exclude = ()
+
+    # rounding errors in the index may leave a tiny weight on seen images, so skip them
+    with stats.phase('select'):
+        while True:
+            position = index.find(random.uniform(0, total_redrum_score))
+            image = images[position]
+            if not (config.unseen_only and image['id'] in seen) and position not in exclude:
+                break
+
+    score = scores[position]
     print("Selected {0} ({1}) with score {2} out of {3} images".format(
         image['link'],
-        image.get('subreddit', None), # FIXME: some images have no subreddit attr?
-        image['redrum_score'],
-        len(images)
+        ', '.join(image.get('subreddits') or [str(image.get('subreddit'))]),
+        score,
+        index.candidates
     ))
-    print("The probability of selecting this image was {0}".format(image['redrum_score']/total_redrum_score))
+    print("The probability of selecting this image was {0}".format(score/total_redrum_score))
+
+    return position
+
+
+# stream an image to `path` in chunks, replacing it atomically once complete
+def download_image(config, link, path, session=None):
+    if session is None:
+        import requests
+        session = requests
+    response = session.get(link, headers=config.headers, stream=True)
+    stats.count('image_downloads')
+    if response.status_code != 200:
+        logger.error("Got response {} when downloading image.".format(response.status_code))
+        return False
+
+    temp_path = path + '.part'
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(temp_path, 'wb') as f:
+        for chunk in response.iter_content(chunk_size=config.chunk_size):
+            f.write(chunk)
+            stats.count('bytes', len(chunk))
+    os.replace(temp_path, path)
+    return True
+
+
+# size-bounded directory of downloaded images keyed by image id
+# least recently used images are evicted once the directory is larger than `image_cache_size`
+# `directory`, `max_size` and `name` override the location, size and name in stats for other caches of images
+class ImageCache(object):
+    def __init__(self, config, directory=None, max_size=None, name='image_cache'):
+        self.directory = directory or config.image_cache_dir
+        self.max_size = config.image_cache_size if max_size is None else max_size
+        self.name = name
+        self.stats_file = os.path.join(self.directory, 'stats.json')
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, image_id):
+        return os.path.join(self.directory, image_id)
+
+    # return path of a cached image and mark it as recently used, or None on a miss
+    def get(self, image_id):
+        path = self.path(image_id)
+        hit = os.path.exists(path)
+        if hit:
+            os.utime(path)
+        self.record(hit)
+        return path if hit else None
+
+    # update and print hit/miss counts
+    def record(self, hit):
+        counts = {'hits': 0, 'misses': 0}
+        if os.path.exists(self.stats_file):
+            with open(self.stats_file, 'r') as f:
+                counts.update(json.loads(f.read()))
+        counts['hits' if hit else 'misses'] += 1
+        stats.count(self.name + ('_hits' if hit else '_misses'))
+        with open(self.stats_file, 'w') as f:
+            f.write(json.dumps(counts))
+        print("{0} {1}: {2} hits, {3} misses".format(self.name.replace('_', ' ').capitalize(), 'hit' if hit else 'miss',
+                                                    counts['hits'], counts['misses']))
+
+    # delete least recently used images until the cache fits in `max_size`
+    def evict(self):
+        entries = [entry for entry in os.scandir(self.directory)
+                   if entry.is_file() and entry.path != self.stats_file and not entry.name.endswith('.part')]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        size = sum(entry.stat().st_size for entry in entries)
+        # always keep the most recently used image
+        for entry in entries[:-1]:
+            if size <= self.max_size:
+                break
+            logger.debug("Evicting {0} from image cache".format(entry.name))
+            size -= entry.stat().st_size
+            os.remove(entry.path)
+
+
+# copy a file to `path`, replacing it atomically once complete
+def copy_file(source, path):
+    shutil.copyfile(source, path + '.part')
+    os.replace(path + '.part', path)
+
+
+# put image at `image_file`, preferring a prefetched or cached copy over downloading it
+def fetch_image(config, image, image_file):
+    prefetched = os.path.join(config.prefetch_dir, image['id'])
+    if os.path.exists(prefetched):
+        shutil.move(prefetched, image_file)
+        return True
+
+    if not config.image_cache_size:
+        return download_image(config, image['link'], image_file)
+
+    image_cache = ImageCache(config)
+    path = image_cache.get(image['id'])
+    if path is None:
+        path = image_cache.path(image['id'])
+        if not download_image(config, image['link'], path):
+            return False
+        image_cache.evict()
+    copy_file(path, image_file)
+    return True
+
+
+# cache of images cropped and downscaled to the screen they were selected for
+def resize_cache(config):
+    return ImageCache(config, config.resize_dir, config.resize_cache_size, 'resize_cache')
+
+
+# name of an image in the resize cache, which differs for each screen size
+def resized_id(image_id, screen):
+    return '{0}_{1}x{2}'.format(image_id, screen[0], screen[1])
+
+
+# crop the image at `source` to the screen ratio and downscale it to `width`x`height`, saving it to `path`
+# runs in a worker process, so the memory used decoding a large image is given back once it is done
+# images smaller than the screen are left alone, returning False
+def resize_image(source, path, width, height, quality):
+    from PIL import Image, ImageOps
+    try:
+        with Image.open(source) as image:
+            # let jpegs decode at a reduced scale which is still at least the screen size
+            image.draft('RGB', (width, height))
+            if image.width < width or image.height < height:
+                return False
+            resized = ImageOps.fit(image.convert('RGB'), (width, height), Image.LANCZOS)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        resized.save(path + '.part', 'JPEG', quality=quality)
+        os.replace(path + '.part', path)
+        return True
+    except (IOError, OSError, ValueError, Image.DecompressionBombError) as e:
+        logger.error("Could not resize {0} ({1})".format(source, e))
+        return False
+
+
+# resize images in worker processes, where `jobs` are (source, path, width, height) tuples
+# returns whether each image was resized
+def resize_images(config, jobs):
+    from concurrent.futures import ProcessPoolExecutor
+    try:
+        import PIL
+    except ImportError:
+        logger.error("Pillow is needed to resize images.  Run `pip install redrum[resize]`")
+        return [False] * len(jobs)
 
-    return image
+    if not jobs:
+        return []
+    with stats.phase('resize'):
+        with ProcessPoolExecutor(max_workers=min(len(jobs), os.cpu_count() or 1)) as executor:
+            futures = [executor.submit(resize_image, source, path, width, height, config.resize_quality)
+                       for source, path, width, height in jobs]
+            return [future.result() for future in futures]
 
 
-# set wallpaper
-def set_wallpaper(config, image):
+# set wallpaper, with one image for each screen
+def set_wallpaper(config, images):
 
     print("Applying wallpaper")
 
-    # download image to `image`
+    # download each image to its screen's `image_file`, unless it was already resized for the screen
     try:
-        response = requests.get(image['link'], headers=config.headers)
-        if response.status_code == 200:
-            with open(config.image_file, 'wb') as f:
-                f.write(response.content)
-        else:
-            logging.error("Got response {} when downloading image.".format(response.status_code))
-    except ConnectionError:
-        logging.error("Connection error")
+        with stats.phase('fetch'):
+            jobs = []
+            for image, image_file, screen in zip(images, config.image_files, config.screens):
+                if not config.resize:
+                    fetch_image(config, image, image_file)
+                    continue
+                cache = resize_cache(config)
+                path = cache.get(resized_id(image['id'], screen))
+                if path is not None:
+                    copy_file(path, image_file)
+                    continue
+                # a failed download leaves the previous wallpaper in place, which mustn't be resized and cached as this image
+                if fetch_image(config, image, image_file):
+                    jobs.append((image_file, cache.path(resized_id(image['id'], screen))) + tuple(screen))
+    except IOError as e:
+        # requests is only imported if the image had to be downloaded
+        from requests.exceptions import ConnectionError
+        if not isinstance(e, ConnectionError):
+            raise
+        logger.error("Connection error")
         sys.exit()
 
+    # crop and downscale to the screen so the wallpaper command doesn't have to
+    if config.resize and jobs:
+        for (image_file, path, _, _), resized in zip(jobs, resize_images(config, jobs)):
+            if resized:
+                copy_file(path, image_file)
+        resize_cache(config).evict()
+
+    # all screens are set by one command, which gets the image of screen N as `{image_fileN}`
+    #   and all of them as `{image_files}`
+    image_files = {'image_file{0}'.format(screen): image_file for screen, image_file in enumerate(config.image_files)}
     try:
-        subprocess.check_output(config.wallpaper_command.format(image_file=config.image_file), shell=True)
+        with stats.phase('wallpaper_command'):
+            subprocess.check_output(config.wallpaper_command.format(
+                image_file=config.image_files[0],
+                image_files=' '.join(shlex.quote(image_file) for image_file in config.image_files),
+                **image_files), shell=True)
     except subprocess.CalledProcessError as e:
         logger.error("Command `{}` failed with status {}".format(e.cmd, e.returncode))
         sys.exit()
 
 
-# save date, options, seen images and images to cache
-def save(config, images, date, seen):
+# load list of prefetched images waiting to be set
+def read_prefetched(config):
+    queue_file = os.path.join(config.prefetch_dir, 'queue.json')
+    if not os.path.exists(queue_file):
+        return []
+    with open(queue_file, 'r') as f:
+        return json.loads(f.read())
+
+
+def write_prefetched(config, queue):
+    os.makedirs(config.prefetch_dir, exist_ok=True)
+    queue_file = os.path.join(config.prefetch_dir, 'queue.json')
+    with open(queue_file + '.tmp', 'w') as f:
+        f.write(json.dumps(queue))
+    os.replace(queue_file + '.tmp', queue_file)
+
+
+# check that a prefetched image is still in the cache, still unseen and fully downloaded
+def valid_prefetched(config, images, seen, entry):
+    return (entry.get('screen', 0) < len(config.screens) and
+            entry['position'] < len(images) and
+            images[entry['position']]['id'] == entry['id'] and
+            not (config.unseen_only and entry['id'] in seen) and
+            os.path.exists(entry['path']))
+
+
+# take the next prefetched image for `screen` from the queue, returning its queue entry
+# invalid entries are dropped and images at positions in `exclude` are skipped
+def pop_prefetched(config, images, seen, screen=0, exclude=()):
+    queue = [entry for entry in read_prefetched(config) if valid_prefetched(config, images, seen, entry)]
+    for entry in queue:
+        if entry.get('screen', 0) == screen and entry['position'] not in exclude:
+            queue.remove(entry)
+            write_prefetched(config, queue)
+            print("Selected prefetched {0}".format(entry['link']))
+            return entry
+    write_prefetched(config, queue)
+
+
+# select and download the next `prefetch` images for each screen so the next change doesn't have to wait
+def prefetch(config, images, scores, seen, indexes):
+    from concurrent.futures import ThreadPoolExecutor
+    from requests.exceptions import ConnectionError
+
+    queue = []
+    for entry in read_prefetched(config):
+        if valid_prefetched(config, images, seen, entry):
+            queue.append(entry)
+        # remove downloads which can no longer be used
+        elif os.path.exists(entry['path']):
+            os.remove(entry['path'])
+
+    # draw without replacement from copies of the indexes with queued images removed,
+    #   so every screen gets different images
+    candidates = [ScoreIndex(list(index.tree), index.candidates, True) for index in indexes]
+    for entry in queue:
+        mark_seen(candidates, scores, entry['position'])
+    new_entries = []
+    for screen, screen_candidates in enumerate(candidates):
+        queued = sum(1 for entry in queue if entry.get('screen', 0) == screen)
+        while queued < config.prefetch and screen_candidates.candidates > 0:
+            total = screen_candidates.total()
+            if total <= 0:
+                break
+            position = screen_candidates.find(random.uniform(0, total))
+            image = images[position]
+            if (config.unseen_only and image['id'] in seen) or any(entry['position'] == position for entry in new_entries):
+                continue
+            mark_seen(candidates, scores, position)
+            # prefetch into the image cache if it is enabled
+            if config.image_cache_size:
+                path = ImageCache(config).path(image['id'])
+            else:
+                path = os.path.join(config.prefetch_dir, image['id'])
+            new_entries.append({'position': position,
+                                'screen': screen,
+                                'id': image['id'],
+                                'link': image['link'],
+                                'path': path})
+            queued += 1
+
+    if new_entries:
+        print("Prefetching {0} images".format(len(new_entries)))
+    session = get_session(config)
+
+    def download(entry):
+        if os.path.exists(entry['path']):
+            return True
+        try:
+            return download_image(config, entry['link'], entry['path'], session)
+        except ConnectionError:
+            logger.error("Connection error while prefetching {0}".format(entry['link']))
+            return False
+
+    with ThreadPoolExecutor(max_workers=config.max_concurrency) as executor:
+        downloaded = list(executor.map(download, new_entries))
+    new_entries = [entry for entry, success in zip(new_entries, downloaded) if success]
+
+    # resize prefetched images now too, so setting them is only a copy
+    # downloads outside the image cache aren't needed once resized
+    if config.resize and new_entries:
+        cache = resize_cache(config)
+        jobs = [(entry['path'], cache.path(resized_id(entry['id'], config.screens[entry['screen']])))
+                + tuple(config.screens[entry['screen']]) for entry in new_entries]
+        for entry, (source, path, _, _), resized in zip(new_entries, jobs, resize_images(config, jobs)):
+            if resized:
+                if not config.image_cache_size:
+                    os.remove(source)
+                entry['path'] = path
+        cache.evict()
+
+    queue += new_entries
+    write_prefetched(config, queue)
+    if config.image_cache_size:
+        ImageCache(config).evict()
+
+
+# load images of albums expanded in earlier refreshes as rows of `ALBUM_FIELDS`
+def load_albums(config):
+    if not os.path.exists(config.album_file):
+        return {}
+    with open(config.album_file, 'r') as f:
+        albums = json.loads(f.read())
+    # album files written before images were stored as rows hold dicts
+    for album_id, images in albums.items():
+        albums[album_id] = [[image.get(field) for field in ALBUM_FIELDS] if isinstance(image, dict) else image
+                            for image in images]
+    return albums
+
+
+def save_albums(config, albums):
+    os.makedirs(os.path.dirname(config.album_file), exist_ok=True)
+    with open(config.album_file + '.tmp', 'w') as f:
+        f.write(json.dumps(albums))
+    os.replace(config.album_file + '.tmp', config.album_file)
+
+
+# read (position, id, time) of images seen since the cache was last saved
+def read_journal(config):
+    journal = []
+    if os.path.exists(config.journal_file):
+        with open(config.journal_file, 'r') as f:
+            for line in f:
+                # skip lines left incomplete by a crash
+                if not line.endswith('\n'):
+                    continue
+                try:
+                    fields = line.split()
+                    # journals written before times were recorded have no time
+                    when = int(fields[2]) if len(fields) > 2 else int(time.time())
+                    journal.append((int(fields[0]), fields[1], when))
+                except (ValueError, IndexError):
+                    continue
+    return journal
+
+
+# record a newly seen image without rewriting the whole cache
+def append_journal(config, position, image_id, when):
+    with open(config.journal_file, 'a') as f:
+        f.write("{0} {1} {2}\n".format(position, image_id, when))
+
+
+# convert images decoded from a json cache to `ImageRecord`s, for processes which hold them for long
+# lazily decoded snapshot images and images from a refresh or sync are left as they are
+def hold_images(images):
+    if isinstance(images, snapshot.ImageTable):
+        return images
+    return [ImageRecord.from_json(image) if isinstance(image, dict) else image for image in images]
+
+
+# load cache in either json or binary snapshot format
+# only a snapshot can be checked for freshness without reading every image, a json cache is parsed whole
+def load(config):
+    if snapshot.is_snapshot(config.cache_file):
+        cache_format = 'binary'
+        j = snapshot.load(config.cache_file)
+    else:
+        cache_format = 'json'
+        with open(config.cache_file, 'r') as cache:
+            j = json.loads(cache.read())
+        # images stay dicts when only selecting, as converting them costs more than it saves in a short run,
+        #   see `hold_images`
+
+    # cache will be written back in the configured format
+    if cache_format != config.cache_format:
+        print("Migrating cache from {0} to {1} format".format(cache_format, config.cache_format))
+
+    j['format'] = cache_format
+    j['journal'] = read_journal(config)
+    return j
+
+
+# save date, options, seen images, images, scores and score index of each screen to cache
+# `version` is the version of the index server the images were synced from
+# the cache is replaced atomically and the seen journal is folded into it
+def save(config, images, scores, indexes, date, seen, version=None):
+
+    with stats.phase('save'):
+        # write to cache file
+        if not os.path.exists(config.cache_file):
+            os.makedirs(os.path.dirname(config.cache_file), exist_ok=True)
+        cache = {'date': date,
+                 'version': version,
+                 'fetch_options': config.fetch_options,
+                 'score_options': config.score_options,
+                 'seen': seen.to_json(),
+                 'images': images,
+                 'scores': scores,
+                 'index': [index.to_json() for index in indexes]}
+        if config.cache_format == 'binary':
+            snapshot.save(config.cache_file, cache)
+        else:
+            cache['images'] = [dict(image) for image in images]
+            cache['scores'] = [list(screen_scores) for screen_scores in scores]
+            for index in cache['index']:
+                index['tree'] = list(index['tree'])
+            temp_file = config.cache_file + '.tmp'
+            with open(temp_file, 'w') as f:
+                f.write(json.dumps(cache, indent=4))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_file, config.cache_file)
 
-    # write to cache file
-    if not os.path.exists(config.cache_file):
-        os.makedirs(os.path.dirname(config.cache_file), exist_ok=True)
-    with open(config.cache_file, 'w') as cache:
-        cache.write(json.dumps({'date': date,
-                                'options': config.options,
-                                'seen':seen,
-                                'images': images}, indent=4))
+        if os.path.exists(config.journal_file):
+            os.remove(config.journal_file)
 
 
 class Config(object):
@@ -239,6 +1453,14 @@ class Config(object):
 
         self.screen_width = config.getint('screen_width', 1600)
         self.screen_height = config.getint('screen_height', 900)
+        # screens as [width, height] pairs, each getting its own wallpaper
+        # `screens` overrides `screen_width` and `screen_height`, which are set to the first screen
+        screens = config.get('screens', '').split()
+        if screens:
+            self.screens = [[int(size) for size in screen.lower().split('x')] for screen in screens]
+            self.screen_width, self.screen_height = self.screens[0]
+        else:
+            self.screens = [[self.screen_width, self.screen_height]]
         self.screen_ratio = float(self.screen_width)/self.screen_height
 
         self.subreddits = config.get('subreddits').split('\n')
@@ -256,6 +1478,19 @@ class Config(object):
         self.max_pages = config.getint('max_pages', 5)
         self.url = config.get('url', "https://api.imgur.com/3/gallery/r/{0}/top/all/{1}")
         self.album_url = config.get('album_url', "https://api.imgur.com/3/album/{0}")
+        # number of simultaneous connections to imgur
+        self.max_concurrency = config.getint('max_concurrency', 8)
+        # number of imgur api requests to leave unused for other users of `client_id`
+        self.quota_reserve = config.getint('quota_reserve', 100)
+        # slow down requests once fewer than this many spare requests remain
+        self.quota_slowdown = 1000
+        # longest time to wait between requests when slowed down
+        self.max_request_interval = 10
+        # retry failed requests this many times, doubling the delay each time
+        self.max_retries = config.getint('max_retries', 4)
+        self.retry_delay = 1
+        # seconds to wait for a response
+        self.timeout = 30
 
         # imgur downloading
         self.client_id = config.get('client_id', "5f21952153b5f6c")
@@ -266,18 +1501,545 @@ class Config(object):
 
         # where to store scored image metadata
         self.cache_file = os.path.expanduser(config.get('cache_file', '~/.cache/redrum_cache.json'))
+        # store cache as json or as a compact binary snapshot
+        self.cache_format = config.get('cache_format', 'json')
+        # where to store images of expanded albums, which are only needed when refreshing
+        self.album_file = self.cache_file + '.albums'
+        # where to store gallery pages for conditional requests
+        self.page_cache_file = self.cache_file + '.pages'
+        # where to record progress of a refresh so it can be resumed
+        self.checkpoint_file = self.cache_file + '.refresh'
+        # where to record images seen since the cache was last saved
+        self.journal_file = self.cache_file + '.seen'
+        # forget seen images after this many days or beyond this many, so they can be selected again
+        self.forget_days = config.getfloat('forget_days', 0)
+        self.max_seen = config.getint('max_seen', 0)
+        # how many seen images to journal before saving them into the cache
+        self.journal_size = config.getint('journal_size', 12)
         # where to store current_image
         self.image_file = os.path.expanduser(config.get('image_file', '~/.cache/redrum_image'))
+        # with several screens, `{screen}` in `image_file` is replaced by the screen number,
+        #   or the number is appended
+        if len(self.screens) == 1:
+            self.image_files = [self.image_file.replace('{screen}', '0')]
+        elif '{screen}' in self.image_file:
+            self.image_files = [self.image_file.replace('{screen}', str(screen)) for screen in range(len(self.screens))]
+        else:
+            self.image_files = ['{0}_{1}'.format(self.image_file, screen) for screen in range(len(self.screens))]
+        # how many upcoming wallpapers to download ahead of time
+        self.prefetch = config.getint('prefetch', 0)
+        # where to store prefetched wallpapers
+        self.prefetch_dir = os.path.expanduser(config.get('prefetch_dir', '~/.cache/redrum_prefetch'))
+        # where to keep previously downloaded images, and how many megabytes to keep
+        self.image_cache_dir = os.path.expanduser(config.get('image_cache_dir', '~/.cache/redrum_images'))
+        self.image_cache_size = config.getint('image_cache_size', 0) * 1024 * 1024
+        # download images in chunks of this many bytes
+        self.chunk_size = 1 << 16
+        # crop and downscale images to the screen before setting them, keeping megabytes of resized images
+        self.resize = config.getboolean('resize', False)
+        self.resize_dir = os.path.expanduser(config.get('resize_dir', '~/.cache/redrum_resized'))
+        self.resize_cache_size = config.getint('resize_cache_size', 50) * 1024 * 1024
+        # jpeg quality of resized images
+        self.resize_quality = 90
         # how to set the background
         self.wallpaper_command = config.get('wallpaper_command', 'feh --bg-scale {image_file}')
         # set cache to expire after 1 week
         self.cache_expiry = timedelta(days=7)
+        # retry partial refreshes after 1 hour
+        self.partial_expiry = timedelta(hours=1)
+        # set a wallpaper once this many images are indexed when building the cache, 0 to wait for all of them
+        self.early_select = config.getint('early_select', 0)
+        # sync images from this index server instead of crawling imgur, see `serve`
+        self.index_server = config.get('index_server', '') or None
+        # seconds to wait for the index server before crawling imgur instead
+        self.sync_timeout = 10
+        # address and port to serve the index on with `--serve`
+        self.serve_address = config.get('serve_address', '0.0.0.0')
+        self.serve_port = config.getint('serve_port', 8484)
+        # change wallpaper this often in daemon mode
+        self.interval = config.getfloat('interval', 120) * 60
+        # append stats of each run to this file as json lines
+        metrics_file = config.get('metrics_file', '')
+        self.metrics_file = os.path.expanduser(metrics_file) if metrics_file else None
         # use ctime format for storing cache date
         self.date_format = "%a %b %d %H:%M:%S %Y"
         # refresh cache when these options change
-        self.options = [self.sfw_only, self.subreddits, self.screen_width, self.screen_height,
-                        self.ratio_midpoint, self.views_midpoint, self.pixel_midpoint,
-                        self.ratio_k, self.views_k, self.pixel_k, self.max_pages, self.url]
+        self.fetch_options = [self.sfw_only, self.subreddits, self.max_pages, self.url]
+        # rescore cached images when these options change
+        self.score_options = [self.screens,
+                              self.ratio_midpoint, self.views_midpoint, self.pixel_midpoint,
+                              self.ratio_k, self.views_k, self.pixel_k]
+
+# scored images, score indexes and seen images held between wallpaper changes
+# `scores` and `indexes` hold the scores and score index of each screen
+class State(object):
+    def __init__(self, date, fetch_options, images, scores, indexes, seen, journal, compact):
+        self.date = date
+        self.fetch_options = fetch_options
+        self.images = images
+        self.scores = scores
+        self.indexes = indexes
+        self.seen = seen
+        self.journal = journal
+        # whether the cache must be saved in full rather than journaled
+        self.compact = compact
+        # whether a wallpaper was already set while refreshing
+        self.wallpaper_set = False
+        # whether images were refreshed, so the refresh checkpoint can be removed once they are saved
+        self.refreshed = False
+        # version of the index server images were synced from, or None if they were crawled
+        self.version = None
+
+    # whether the cache is old or a fetching option has changed
+    # after a failed refresh the cache is used as is until `partial_expiry` has passed
+    def needs_refresh(self, config):
+        cache_age = datetime.now() - datetime.strptime(self.date, config.date_format)
+        if cache_age <= config.cache_expiry and self.fetch_options == config.fetch_options:
+            return False
+        failed = Checkpoint.last_failure(config)
+        return failed is None or time.time() - failed > config.partial_expiry.total_seconds()
+
+    # replace images with freshly fetched ones
+    def update(self, config, date, images, scores):
+        self.date = date
+        self.fetch_options = config.fetch_options
+        self.images = images
+        self.scores = scores
+        forgotten = self.seen.reindex(images)
+        if forgotten:
+            print("Forgot {0} seen images which are no longer indexed".format(forgotten))
+        self.indexes = build_indexes(config, images, scores, self.seen)
+        self.compact = True
+        self.refreshed = True
+
+
+# set wallpaper from the images indexed so far, adding them to `seen`
+# returns positions of the images, or an empty list if there are no candidates yet
+def early_wallpaper(config, images, scores, seen):
+    indexes = build_indexes(config, images, scores, seen)
+    if any(index.candidates == 0 or index.total() <= 0 for index in indexes):
+        return []
+
+    print("Setting wallpaper from the first {0} images while indexing continues".format(len(images)))
+    positions = []
+    for screen, index in enumerate(indexes):
+        positions.append(weighted_select(config, images, scores[screen], seen, index, positions))
+    set_wallpaper(config, [images[position] for position in positions])
+    for position in positions:
+        seen.add(images[position]['id'], position)
+    return positions
+
+
+# fetch and score images from imgur, returning the refresh date, images, scores,
+#   positions of images set as wallpaper during the refresh and whether every page could be fetched
+# if `seen` is given and `early_select` is set, a wallpaper is set once `early_select` images are indexed
+def refresh(config, seen=None):
+    early = []
+    with stats.phase('refresh'):
+        albums = load_albums(config)
+        ingest = Ingest(config, albums)
+        images = []
+        scores = [[] for screen in config.screens]
+        try:
+            for page_images, page_scores in ingest.score(ingest.dedup(ingest.filter(ingest.expand(ingest.pages())))):
+                images += page_images
+                for screen_scores, screen_page_scores in zip(scores, page_scores):
+                    screen_scores += screen_page_scores
+                if seen is not None and config.early_select and not early and len(images) >= config.early_select:
+                    early = early_wallpaper(config, images, scores, seen)
+            complete = ingest.finish()
+        # a refresh which fails keeps its checkpoint to resume from, but mustn't leave it open
+        finally:
+            ingest.checkpoint.close()
+
+        # make sure we actually got results
+        # if not everything could be fetched, a previous cache may still be used
+        if len(images) == 0 and complete:
+            print("No results found")
+            sys.exit()
+
+        # rescore images which were scored before the most viewed image was indexed
+        if ingest.provisional:
+            scores = get_scores(config, images)
+
+    # a partial index is usable, but is dated so that it expires after `partial_expiry`
+    date = datetime.now()
+    if not complete:
+        print("Refreshing again in {0}".format(config.partial_expiry))
+        date -= config.cache_expiry - config.partial_expiry
+    return date.strftime(config.date_format), images, scores, early, complete
+
+
+# get changes to `images` since `version` from `index_server`
+# returns the refresh date, updated images, their scores and the server's version, or None if the server can't be reached
+def sync(config, images=(), version=None):
+    import requests
+    from requests.exceptions import RequestException
+
+    print("Syncing images from {0}".format(config.index_server))
+    with stats.phase('sync'):
+        try:
+            response = requests.get(config.index_server.rstrip('/') + '/index',
+                                    params={} if version is None else {'since': version},
+                                    timeout=config.sync_timeout)
+            response.raise_for_status()
+            stats.count('bytes', len(response.content))
+            j = response.json()
+        except (RequestException, ValueError) as e:
+            logger.error("Could not sync from index server ({0}), crawling Imgur instead".format(e))
+            return None
+
+        received = [ImageRecord.from_json(dict(zip(j['fields'], record))) for record in j['images']]
+        if j['full']:
+            images = received
+        # changed images keep their position, so positions of seen images stay valid
+        else:
+            removed = set(j['removed'])
+            changed = {image['id']: image for image in received}
+            images = [changed.pop(image['id'], image) for image in images if image['id'] not in removed]
+            images += changed.values()
+        print("Received {0} {1} images and {2} removals from index version {3}".format(
+            len(received), 'indexed' if j['full'] else 'changed', len(j.get('removed', [])), j['version']))
+
+    if len(images) == 0:
+        logger.error("Index server has no images, crawling Imgur instead")
+        return None
+    return datetime.now().strftime(config.date_format), images, get_scores(config, images), j['version']
+
+
+# get fresh images from `index_server` if one is set, or from imgur if it isn't or can't be reached
+# `images` and `version` are the images last synced from the server, so only changes are sent
+# returns the same as `refresh` followed by the server's version, or None if images were crawled
+def fetch_images(config, seen=None, images=(), version=None):
+    if config.index_server:
+        synced = sync(config, images, version)
+        if synced is not None:
+            date, images, scores, version = synced
+            return date, images, scores, [], True, version
+    return refresh(config, seen) + (None,)
+
+
+# rescore images after a scoring option has changed
+def rescore(config, state):
+    print("Rescoring cache...")
+    state.scores = get_scores(config, state.images)
+    state.indexes = build_indexes(config, state.images, state.scores, state.seen)
+    state.compact = True
+
+
+# load scored images from cache, refreshing or rescoring it if necessary
+# if `stale` is set, an expired cache is returned as is so it can be refreshed later
+# if `early` is set, a wallpaper may be set while refreshing, see `early_select`
+def load_state(config, force_refresh=False, stale=False, early=False):
+
+    # attempt to load scored images from cache
+    if not os.path.exists(config.cache_file):
+        print("No previous score cache found at {0}.  This may take a minute...".format(config.cache_file))
+        seen = Seen()
+        date, images, scores, early, complete, version = fetch_images(config, seen if early else None)
+        if len(images) == 0:
+            print("No results found")
+            sys.exit()
+        state = State(date, config.fetch_options, images, scores,
+                      build_indexes(config, images, scores, seen), seen, [], True)
+        state.wallpaper_set = bool(early)
+        state.refreshed = complete
+        state.version = version
+        return state
+
+    with stats.phase('load'):
+        j = load(config)
+    print("Found cache at {0}".format(config.cache_file))
+    # caches written before scores were stored have neither scores nor fetch options, so they are refreshed
+    #   or, if a refresh can't be done now, rescored below
+    state = State(j['date'], j.get('fetch_options'), j['images'], j.get('scores'), None,
+                  Seen.from_json(j['seen']), j['journal'],
+                  # migrated caches must be saved in full
+                  j['format'] != config.cache_format)
+    state.version = j.get('version')
+
+    # apply images seen since the cache was saved
+    # images forgotten and seen again since then are already removed from the cached index, but move to the end of `seen`
+    # an image forgotten and selected again before the journal was folded in is journaled more than once,
+    #   but is only marked seen once
+    journaled = {image_id: position for position, image_id, when in state.journal if image_id not in state.seen}
+    for position, image_id, when in state.journal:
+        state.seen.add(image_id, position, when)
+
+    # caches written before positions were recorded have to find them once
+    if state.seen.unindexed():
+        state.seen.reindex(state.images)
+        state.compact = True
+
+    # if the cache is old or a fetching option has changed, update it
+    early_positions = []
+    if force_refresh or (state.needs_refresh(config) and not stale):
+        print("Refreshing cache...")
+        # reload image metadata
+        date, images, scores, early_positions, complete, version = fetch_images(
+            config, state.seen if early else None, state.images, state.version)
+        state.wallpaper_set = bool(early_positions)
+        if complete:
+            state.update(config, date, images, scores)
+            state.version = version
+            return state
+
+        # keep selecting from the previous cache until a refresh can fetch everything
+        print("Using the previous cache until the refresh can be finished")
+        # wallpapers set early were picked from the partial index, so their positions refer to it
+        if early_positions:
+            state.seen.reindex(state.images)
+
+    # if only a scoring option has changed, rescore cached images
+    if state.scores is None or j.get('score_options') != config.score_options:
+        rescore(config, state)
+
+    # otherwise, fetch score indexes from cache
+    elif ('index' in j and not early_positions and
+          all(index['unseen_only'] == config.unseen_only for index in j['index'])):
+        state.indexes = [ScoreIndex(**index) for index in j['index']]
+        for position in journaled.values():
+            mark_seen(state.indexes, state.scores, position)
+
+    else:
+        state.indexes = build_indexes(config, state.images, state.scores, state.seen)
+        state.compact = True
+
+    return state
+
+
+# save state to cache, folding in the journal
+def save_state(config, state):
+    save(config, state.images, state.scores, state.indexes, state.date, state.seen, state.version)
+    state.journal = []
+    state.compact = False
+    if state.refreshed:
+        Checkpoint.remove(config)
+        state.refreshed = False
+
+
+# select a different image for each screen and set them as wallpaper, preferring already prefetched images
+def change_wallpaper(config, state):
+    # forget images seen long ago so they can be selected again
+    # until the cache is next saved, this is repeated after loading it, which is cheaper than saving now
+    for position in state.seen.expire(config):
+        mark_unseen(state.indexes, state.scores, position)
+
+    positions = []
+    for screen in range(len(config.screens)):
+        entry = pop_prefetched(config, state.images, state.seen, screen, positions) if config.prefetch else None
+        if entry is not None:
+            stats.count('prefetch_hits')
+            position = entry['position']
+        else:
+            if config.prefetch:
+                stats.count('prefetch_misses')
+            position = weighted_select(config, state.images, state.scores[screen], state.seen,
+                                       state.indexes[screen], positions)
+        positions.append(position)
+
+    set_wallpaper(config, [state.images[position] for position in positions])
+    for position in positions:
+        image = state.images[position]
+        if image['id'] not in state.seen:
+            when = int(time.time())
+            state.seen.add(image['id'], position, when)
+            mark_seen(state.indexes, state.scores, position)
+            state.journal.append((position, image['id'], when))
+            if not state.compact and len(state.journal) < config.journal_size:
+                append_journal(config, position, image['id'], when)
+
+    # fold the journal into the cache once it gets long
+    if state.compact or len(state.journal) >= config.journal_size:
+        save_state(config, state)
+
+    # download upcoming wallpapers after this change is complete
+    if config.prefetch:
+        with stats.phase('prefetch'):
+            prefetch(config, state.images, state.scores, state.seen, state.indexes)
+
+
+# print stats if `show` is set and append them to `metrics_file`, then start counting again
+def report_stats(config, show=False):
+    if show:
+        stats.report()
+    if config.metrics_file:
+        stats.write(config.metrics_file)
+    stats.reset()
+
+
+# keep scored images in memory and change wallpaper every `interval`
+# the cache is refreshed in the background when it expires and the config is reloaded on SIGHUP
+# stats are reported after every wallpaper change
+def daemon(config_path, force_refresh=False, show_stats=False):
+    config = Config(config_path)
+    state = load_state(config, force_refresh, stale=True)
+    state.images = hold_images(state.images)
+    lock = threading.Lock()
+    wake = threading.Event()
+    reload_config = threading.Event()
+    refreshing = threading.Event()
+
+    def hangup(signum, frame):
+        reload_config.set()
+        wake.set()
+    signal.signal(signal.SIGHUP, hangup)
+
+    def refresh_worker(config):
+        try:
+            print("Refreshing cache in background...")
+            with lock:
+                images, version = state.images, state.version
+            date, images, scores, _, complete, version = fetch_images(config, images=images, version=version)
+            # keep using the previous cache until a refresh can fetch everything
+            if not complete:
+                print("Using the previous cache until the refresh can be finished")
+                return
+            with lock:
+                state.update(config, date, images, scores)
+                state.version = version
+                save_state(config, state)
+        except (Exception, SystemExit) as e:
+            logger.error("Cache refresh failed: {0}".format(e))
+        finally:
+            refreshing.clear()
+
+    next_change = time.time()
+    while True:
+        if reload_config.is_set():
+            reload_config.clear()
+            print("Reloading config from {0}".format(config_path))
+            old_config = config
+            config = Config(config_path)
+            if (config.score_options != old_config.score_options or
+                    config.unseen_only != old_config.unseen_only):
+                with lock:
+                    rescore(config, state)
+                    save_state(config, state)
+
+        if state.needs_refresh(config) and not refreshing.is_set():
+            refreshing.set()
+            threading.Thread(target=refresh_worker, args=(config,), daemon=True).start()
+
+        if time.time() >= next_change:
+            with lock:
+                try:
+                    change_wallpaper(config, state)
+                except SystemExit:
+                    logger.error("Failed to change wallpaper, retrying in {0} minutes".format(config.interval / 60))
+                report_stats(config, show_stats)
+            next_change = time.time() + config.interval
+
+        wake.wait(max(0, next_change - time.time()))
+        wake.clear()
+
+
+# images served by an index server, each with the version it last changed in
+# versions are times, so clients of an earlier run of the server get every image again
+class SharedIndex(object):
+    def __init__(self, images):
+        self.lock = threading.Lock()
+        self.version = self.base = int(time.time())
+        self.records = {}
+        self.removed = {}
+        self.update(images, self.version)
+
+    # replace images with freshly refreshed ones, recording which changed and which were removed
+    def update(self, images, version=None):
+        version = version or max(self.version + 1, int(time.time()))
+        records = {}
+        for image in images:
+            record = [image.get(field) for field in IMAGE_FIELDS]
+            old = self.records.get(image['id'])
+            records[image['id']] = (old[0] if old is not None and old[1] == record else version, record)
+        with self.lock:
+            for image_id in self.records:
+                if image_id not in records:
+                    self.removed[image_id] = version
+            for image_id in records:
+                self.removed.pop(image_id, None)
+            self.records = records
+            self.version = version
+
+    # json for clients with images of version `since`, or every image if `since` is None or unknown
+    def changes(self, since=None):
+        with self.lock:
+            full = since is None or not self.base <= since <= self.version
+            return {'version': self.version,
+                    'full': full,
+                    'fields': IMAGE_FIELDS,
+                    'images': [record for version, record in self.records.values() if full or version > since],
+                    'removed': [] if full else [image_id for image_id, version in self.removed.items() if version > since]}
+
+
+# maintain one index and serve it over http to machines with `index_server` set
+# clients get changes since the version they have from /index?since=<version>, gzipped if they accept it
+def serve(config_path, force_refresh=False, show_stats=False):
+    import gzip
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from urllib.parse import urlparse, parse_qs
+
+    config = Config(config_path)
+    # the server crawls imgur itself
+    config.index_server = None
+    state = load_state(config, force_refresh, stale=True)
+    if state.compact:
+        save_state(config, state)
+    state.images = hold_images(state.images)
+    index = SharedIndex(state.images)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != '/index':
+                return self.send(404, b'Not found', 'text/plain')
+            try:
+                since = int(parse_qs(url.query)['since'][0])
+            except (KeyError, ValueError):
+                since = None
+            body = json.dumps(index.changes(since), separators=(',', ':')).encode('utf-8')
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                return self.send(200, gzip.compress(body), 'application/json', {'Content-Encoding': 'gzip'})
+            self.send(200, body, 'application/json')
+
+        def send(self, status, body, content_type, headers={}):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for header, value in headers.items():
+                self.send_header(header, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((config.serve_address, config.serve_port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("Serving index of {0} images at http://{1}:{2}/index".format(len(state.images), config.serve_address, config.serve_port))
+    report_stats(config, show_stats)
+
+    # refresh the index when it expires, keeping the previous one if a refresh is incomplete
+    try:
+        while True:
+            if state.needs_refresh(config):
+                print("Refreshing index...")
+                date, images, scores, _, complete = refresh(config)
+                if complete:
+                    state.update(config, date, images, scores)
+                    save_state(config, state)
+                    index.update(images)
+                    print("Serving index version {0} of {1} images".format(index.version, len(images)))
+                else:
+                    print("Serving the previous index until the refresh can be finished")
+                report_stats(config, show_stats)
+            time.sleep(60)
+    finally:
+        server.shutdown()
+
 
 def main():
 
@@ -285,7 +2047,11 @@ def main():
     parser.add_argument('-v', '--version', action='version', version=__version__, help="show version information")
     parser.add_argument('--refresh', action='store_true', default=False, help="force a cache refresh")
     parser.add_argument('--noset', action='store_true', default=False, help="don't select and set and set wallpaper")
-    parser.add_argument('--config', action='store_true', default='~/.config/redrum.ini', help="use a different config path")
+    parser.add_argument('--config', metavar='PATH', default='~/.config/redrum.ini', help="use a different config path")
+    parser.add_argument('--daemon', action='store_true', default=False, help="keep running and change wallpaper every `interval` minutes")
+    parser.add_argument('--serve', action='store_true', default=False, help="keep the index refreshed and serve it to machines with `index_server` set")
+    parser.add_argument('--stats', action='store_true', default=False, help="show time spent in each phase, requests made and cache hit rates")
+    parser.add_argument('--profile', metavar='PATH', default=None, help="write cProfile output for the run to PATH")
     parser.add_argument('--debug', action='store_true', default=False, help="enable debug messages")
 
     args = parser.parse_args()
@@ -294,41 +2060,36 @@ def main():
         logger.setLevel(logging.DEBUG)
         logger.debug('Debugging enabled...')
 
-    config = Config(args.config)
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
 
-    # attempt to load scored images from cache
-    if not os.path.exists(config.cache_file):
-        print("No previous score cache found at {0}.  This may take a minute...".format(config.cache_file))
-        date = datetime.strftime(datetime.now(), config.date_format)
-        images = get_images(config)
-        seen = []
-
-    else:
-        with open(config.cache_file, 'r') as cache:
-            j = json.loads(cache.read())
-            print("Found cache at {0}".format(config.cache_file))
-            date = j['date']
-            # if the cache is old or `options` has changed, update it
-            cache_age = datetime.now() - datetime.strptime(date, config.date_format)
-            if (cache_age > config.cache_expiry or j['options'] != config.options or args.refresh):
-                print("Refreshing cache...")
-                # reload image metadata
-                images = get_images(config)
-                date = datetime.now().strftime(config.date_format)
-
-            # otherwise, fetch scored images from cache
-            else:
-                images = j['images']
-
-        seen = j['seen']
-
-    # select image and set as wallpaper
-    if not args.noset:
-        image = weighted_select(config, images, seen)
-        set_wallpaper(config, image)
-        seen.append(image['id'])
-
-    save(config, images, date, seen)
+    config = None
+    try:
+        if args.daemon:
+            daemon(args.config, args.refresh, args.stats)
+            return
+        if args.serve:
+            serve(args.config, args.refresh, args.stats)
+            return
+
+        config = Config(args.config)
+        state = load_state(config, args.refresh, early=not args.noset)
+
+        if not args.noset and not state.wallpaper_set:
+            change_wallpaper(config, state)
+        elif state.compact:
+            save_state(config, state)
+
+    # report runs which end early with sys.exit too
+    finally:
+        if config is not None:
+            report_stats(config, args.stats)
+        if args.profile:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            print("Wrote profile to {0}".format(args.profile))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,193 @@
+## Compact binary snapshot format for the redrum score cache
+## Only the image fields redrum uses are stored, in memory-mappable columns,
+##   so a run can pick an image without parsing the whole cache
+
+## file layout:
+##   magic | header length | extras length | header json | extras json | columns
+## the header holds small metadata (dates, options, column offsets), the extras
+##   hold seen images, and each column is 8 byte aligned
+## the scores and score index of every screen are stored one after another in the
+##   score and index columns
+
+import array
+import json
+import mmap
+import os
+import struct
+import sys
+
+try:
+    from collections.abc import Sequence
+except ImportError:
+    from collections import Sequence
+
+MAGIC = b'REDRUM\x00\x01'
+LENGTHS = struct.Struct('<II')
+
+# image fields stored as numeric columns and their array typecodes
+NUMERIC_COLUMNS = [('width', 'I'), ('height', 'I'), ('views', 'Q'), ('nsfw', 'B')]
+# image fields stored as offsets into a utf-8 string table
+STRING_COLUMNS = ['id', 'link']
+# subreddits are stored as codes into a list of names in the header
+# the subreddits each image was found in are stored as offsets into a column of codes
+NO_SUBREDDIT = 0xFFFF
+# metadata too large for the header
+EXTRAS = ['seen']
+
+
+# check whether the file at `path` is a snapshot
+def is_snapshot(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+# read-only list of image dicts backed by snapshot columns
+class ImageTable(Sequence):
+    def __init__(self, columns, subreddits, length):
+        self.columns = columns
+        self.subreddits = subreddits
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def string(self, name, i):
+        offsets = self.columns[name + '.offsets']
+        return bytes(self.columns[name + '.data'][offsets[i]:offsets[i + 1]]).decode('utf-8')
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError('image index out of range')
+
+        image = {name: self.string(name, i) for name in STRING_COLUMNS}
+        for name, _ in NUMERIC_COLUMNS:
+            image[name] = self.columns[name][i]
+        image['nsfw'] = bool(image['nsfw'])
+        code = self.columns['subreddit'][i]
+        image['subreddit'] = None if code == NO_SUBREDDIT else self.subreddits[code]
+        # snapshots written before duplicates were merged have no list of subreddits
+        if 'subreddits.offsets' in self.columns:
+            offsets = self.columns['subreddits.offsets']
+            image['subreddits'] = [self.subreddits[code]
+                                   for code in self.columns['subreddits.codes'][offsets[i]:offsets[i + 1]]]
+        return image
+
+
+# encode a list of strings as an offsets column and a data column
+def encode_strings(values):
+    offsets = array.array('I', [0])
+    data = bytearray()
+    for value in values:
+        data += value.encode('utf-8')
+        offsets.append(len(data))
+    return offsets, data
+
+
+# load a snapshot as a cache dict with lazily decoded images
+def load(path):
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    header_length, extras_length = LENGTHS.unpack_from(buffer, len(MAGIC))
+    start = len(MAGIC) + LENGTHS.size
+    header = json.loads(buffer[start:start + header_length].decode('utf-8'))
+    if header['byteorder'] != sys.byteorder:
+        raise ValueError("Snapshot was written on a machine with different byte order")
+    start += header_length
+    extras = json.loads(buffer[start:start + extras_length].decode('utf-8'))
+
+    view = memoryview(buffer)
+    columns = {}
+    for name, (typecode, offset, size) in header.pop('columns').items():
+        columns[name] = view[offset:offset + size].cast(typecode)
+
+    length = header.pop('length')
+    images = ImageTable(columns, header.pop('subreddits'), length)
+    del header['byteorder']
+    cache = dict(header, **extras)
+    cache['images'] = images
+    # snapshots written before multiple screens were supported hold a single index
+    if isinstance(cache['index'], dict):
+        cache['index'] = [cache['index']]
+    cache['scores'] = []
+    for screen, index in enumerate(cache['index']):
+        cache['scores'].append(columns['score'][screen * length:(screen + 1) * length])
+        index['tree'] = columns['index'][screen * (length + 1):(screen + 1) * (length + 1)]
+    return cache
+
+
+# atomically write images, scores, score index and metadata to a snapshot
+# `cache` holds the same keys as the json cache, with scores and an index for each screen
+def save(path, cache):
+    images = cache['images']
+    length = len(images)
+
+    # copy columns straight from an unchanged snapshot, otherwise encode image dicts
+    if isinstance(images, ImageTable):
+        columns = dict(images.columns)
+        subreddits = images.subreddits
+    else:
+        columns = {}
+        for name, typecode in NUMERIC_COLUMNS:
+            columns[name] = array.array(typecode, [int(image[name] or 0) for image in images])
+        for name in STRING_COLUMNS:
+            columns[name + '.offsets'], columns[name + '.data'] = encode_strings(image[name] for image in images)
+        subreddits = set(image.get('subreddit') for image in images)
+        for image in images:
+            subreddits.update(image.get('subreddits', []))
+        subreddits = sorted(subreddits - {None})
+        codes = {subreddit: code for code, subreddit in enumerate(subreddits)}
+        columns['subreddit'] = array.array('H', [codes.get(image.get('subreddit'), NO_SUBREDDIT)
+                                                 for image in images])
+        columns['subreddits.offsets'] = array.array('I', [0])
+        columns['subreddits.codes'] = array.array('H')
+        for image in images:
+            columns['subreddits.codes'].extend(codes[subreddit] for subreddit in image.get('subreddits', []))
+            columns['subreddits.offsets'].append(len(columns['subreddits.codes']))
+    columns['score'] = array.array('d')
+    columns['index'] = array.array('d')
+    for scores, index in zip(cache['scores'], cache['index']):
+        columns['score'].extend(scores)
+        columns['index'].extend(index['tree'])
+
+    header = {key: value for key, value in cache.items()
+              if key not in EXTRAS + ['images', 'scores', 'index']}
+    header['index'] = [{key: value for key, value in index.items() if key != 'tree'}
+                       for index in cache['index']]
+    header['length'] = length
+    header['subreddits'] = subreddits
+    header['byteorder'] = sys.byteorder
+
+    extras = json.dumps({key: cache[key] for key in EXTRAS}).encode('utf-8')
+
+    # column offsets are stored in the header, so recompute them until the header length settles
+    layout = {name: [memoryview(column).format, 0, memoryview(column).nbytes]
+              for name, column in columns.items()}
+    header['columns'] = layout
+    while True:
+        encoded_header = json.dumps(header).encode('utf-8')
+        offset = len(MAGIC) + LENGTHS.size + len(encoded_header) + len(extras)
+        changed = False
+        for name in sorted(layout):
+            offset += -offset % 8
+            if layout[name][1] != offset:
+                layout[name][1] = offset
+                changed = True
+            offset += layout[name][2]
+        if not changed:
+            break
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(LENGTHS.pack(len(encoded_header), len(extras)))
+        f.write(encoded_header)
+        f.write(extras)
+        for name in sorted(layout):
+            f.write(b'\0' * (layout[name][1] - f.tell()))
+            f.write(memoryview(columns[name]).cast('B'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
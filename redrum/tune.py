@@ -9,11 +9,16 @@
 ##   tune.py --ratio_midpoint .8 D331RXf P7I7bML DX352lK # override ratio_midpoint
 
 import argparse
-import redrum
-import json
+import logging
+from redrum import redrum
+from redrum.tuning import Corpus, top_share
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+logger = logging.getLogger(__name__)
 
 # read in parameter overrides
 parser = argparse.ArgumentParser()
+parser.add_argument('--config', metavar='PATH', default='~/.config/redrum.ini', help="use a different config path")
 parser.add_argument('--ratio_midpoint', type=float)
 parser.add_argument('--ratio_k', type=float)
 parser.add_argument('--pixel_midpoint', type=float)
@@ -23,35 +28,27 @@ parser.add_argument('--views_k', type=float)
 parser.add_argument('ids', metavar='imgur_id', type=str, nargs='+', help="image ID to score from the cache")
 
 args = parser.parse_args()
-if args.ratio_midpoint:
-    redrum.ratio_midpoint = args.ratio_midpoint
-if args.ratio_k:
-    redrum.ratio_k = args.ratio_k
-if args.pixel_midpoint:
-    redrum.pixel_midpoint = args.pixel_midpoint
-if args.pixel_k:
-    redrum.pixel_k = args.pixel_k
-if args.views_midpoint:
-    redrum.views_midpoint = args.views_midpoint
-if args.views_k:
-    redrum.views_k = args.views_k
-if args.ids:
-    ids = args.ids
-
-# load images in the cache
-f = open(redrum.cache_file, 'r')
-j = json.loads(f.read())
-images = j['images']
+config = redrum.Config(args.config)
+for option in ['ratio_midpoint', 'ratio_k', 'pixel_midpoint', 'pixel_k', 'views_midpoint', 'views_k']:
+    if getattr(args, option) is not None:
+        setattr(config, option, getattr(args, option))
+ids = args.ids
 
-max_views = max([image['views'] for image in images])
+# load images in the cache and score all of them, so each image's selection probability is known
+corpus = Corpus(config)
+weights = corpus.weights(corpus.score()[0])
+total_weight = weights.sum()
 
 # print scores in a tabular format
 print("{:^60} {:<31}".format("Input Scores", "Logistic Scores"))
-print("%-12s  |  %-12s%-12s%-7s  |  %-12s%-12s%-7s  |  %-12s" % ("ID", "ratio", "views", "pixel", "ratio", "views", "pixel", "final_score"))
-print("=" * 103)
+print("%-12s  |  %-12s%-12s%-7s  |  %-12s%-12s%-7s  |  %-12s  |  %-12s" % ("ID", "ratio", "views", "pixel", "ratio", "views", "pixel", "final_score", "probability"))
+print("=" * 122)
 # calculate and print scores and logistic scores for each image
 for id in ids:
-    image = [image for image in images if image['id'] == id][0]
+    image = corpus.image(id)
+    if image is None:
+        logger.error("Image ID {} not found in cache.".format(id))
+        continue
 
     [final_score,
      ratio_score,
@@ -59,16 +56,20 @@ for id in ids:
      pixel_score,
      ratio_logistic_score,
      views_logistic_score,
-     pixel_logistic_score] = redrum.score_image(image, max_views)
+     pixel_logistic_score] = redrum.score_image(config, image, corpus.max_views)
+    probability = weights[corpus.rows[id]] / total_weight if total_weight > 0 else 0
 
 
-    print("%-12s  |  %-12.5f%-12.5f%-7.5f  |  %-12.5f%-12.5f%-7.5f  |  %-12.11f" % (image['id'],
+    print("%-12s  |  %-12.5f%-12.5f%-7.5f  |  %-12.5f%-12.5f%-7.5f  |  %-12.11f  |  %-12.3e" % (image['id'],
                                                                               ratio_score,
                                                                               views_score,
                                                                               pixel_score,
                                                                               ratio_logistic_score,
                                                                               views_logistic_score,
                                                                               pixel_logistic_score,
-                                                                              final_score))
+                                                                              final_score,
+                                                                              probability))
+
+    print("-" * 122)
 
-    print("-" * 103)
+print("The top 1% of {0} images hold {1:.1%} of the selection probability".format(len(corpus), top_share(weights)))
@@ -1,47 +1,86 @@
 #!/bin/python
 # Evan Widloski - 2016-10-13
 # Graphical interface for finding midpoint and k
+# With --sweep, scores the cache for many parameter combinations instead and prints a ranked table
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.widgets import Slider, Button, RadioButtons
-from redrum import redrum
-import math
+from redrum import redrum, tuning
+from redrum.tuning import Corpus
 import argparse
-import json
 import logging
 import sys
-import os
-from configparser import SafeConfigParser
+import time
 
 logging.basicConfig(level=logging.INFO, format="%(message)s")
 logger = logging.getLogger(__name__)
 # hide annoying requests messages
 logging.getLogger("requests").setLevel(logging.WARNING)
 
-parser = argparse.ArgumentParser(description='Redrum sigmoid tuning script.  Provide two images of different quality and Adjust sliders to control how scores are weighted. Copy these values to your config to apply.')
-parser.add_argument('image_id_a', metavar='imgur_id', type=str, help="image ID to score from the cache")
-parser.add_argument('image_id_b', metavar='imgur_id', type=str, help="image ID to score from the cache")
-parser.add_argument('--config', action='store_true', default=os.path.expanduser('~/.config/redrum.ini'), help="use a different config path")
+parser = argparse.ArgumentParser(description='Redrum sigmoid tuning script.  Provide images of different quality and Adjust sliders to control how scores are weighted.  The distribution of scores over the whole cache is shown too.  Copy these values to your config to apply.')
+parser.add_argument('ids', metavar='imgur_id', type=str, nargs='*', help="image ID to score from the cache")
+parser.add_argument('--config', metavar='PATH', default='~/.config/redrum.ini', help="use a different config path")
+parser.add_argument('--sweep', action='store_true', help="rank many parameter combinations by selection entropy, effective candidates and low resolution mass")
+parser.add_argument('--samples', metavar='N', type=int, default=1000, help="random parameter combinations to sweep")
+parser.add_argument('--grid', metavar='STEPS', type=int, help="sweep a grid of STEPS values per parameter instead of random combinations")
+parser.add_argument('--seed', type=int, help="random seed for the sweep")
+parser.add_argument('--low_resolution', type=float, default=0.5, help="pixel score below which an image counts as low resolution")
+parser.add_argument('--max_low_res', type=float, default=0.05, help="rank combinations with more low resolution probability mass than this last")
+parser.add_argument('--min_top_share', type=float, default=0.1, help="rank combinations whose top 1%% of images hold less probability than this last")
+parser.add_argument('--top', metavar='N', type=int, default=20, help="combinations to print")
+parser.add_argument('--output', metavar='PATH', help="write the whole ranked table to a csv file")
 args = parser.parse_args()
 
-# attempt to load settings from file
-config_parser = SafeConfigParser()
 config = redrum.Config(args.config)
 
-fig, ax = plt.subplots(figsize=(15,5))
+
+# score the whole cache for many parameter combinations and print them ranked
+def sweep():
+    corpus = Corpus(config)
+    parameters = tuning.sweep_parameters(args.samples, args.grid, args.seed)
+    start = time.time()
+    metrics = corpus.sweep(parameters, args.low_resolution)
+    order = tuning.rank(metrics, args.max_low_res, args.min_top_share)
+    print("Swept {0} combinations over {1} images in {2:.1f}s".format(len(parameters), len(corpus), time.time() - start))
+    tuning.print_table(parameters, metrics, order, args.top)
+    if args.output:
+        tuning.write_table(args.output, parameters, metrics, order)
+
+# the sweep doesn't need matplotlib, so run it before importing it
+if args.sweep:
+    sweep()
+    sys.exit()
+
+import matplotlib.pyplot as plt
+from matplotlib.widgets import Slider, Button, RadioButtons
+
+# wait this many milliseconds after the last slider change before rescoring the whole cache
+debounce_interval = 150
+
+fig, ax = plt.subplots(figsize=(18,5))
 plt.subplots_adjust(left=0.05, bottom=0.3, right=.95)
 
 x = np.arange( 0, 1, 0.001)
 
+#-------------- Load Images -----------------
+
+corpus = Corpus(config)
+ids = []
+for image_id in args.ids:
+    if image_id in corpus.rows:
+        ids.append(image_id)
+    else:
+        logger.error('Image ID {} not found in cache.'.format(image_id))
+rows = [corpus.rows[image_id] for image_id in ids]
+colors = ['r', 'b', 'g', 'm', 'c', 'y']
+
 #-------------- Inputs -----------------
 
 axis_color = 'lightgoldenrodyellow'
-slide_ratio_midpoint_axis = plt.axes([0.05,  0.1, 0.15, 0.03], axisbg=axis_color)
-slide_ratio_k_axis =        plt.axes([0.05, 0.15, 0.15, 0.03], axisbg=axis_color)
-slide_pixel_midpoint_axis = plt.axes([0.29,  0.1, 0.15, 0.03], axisbg=axis_color)
-slide_pixel_k_axis =        plt.axes([0.29, 0.15, 0.15, 0.03], axisbg=axis_color)
-slide_views_midpoint_axis = plt.axes([0.52,  0.1, 0.15, 0.03], axisbg=axis_color)
-slide_views_k_axis =        plt.axes([0.52, 0.15, 0.15, 0.03], axisbg=axis_color)
+slide_ratio_midpoint_axis = plt.axes([0.05,  0.1, 0.15, 0.03], facecolor=axis_color)
+slide_ratio_k_axis =        plt.axes([0.05, 0.15, 0.15, 0.03], facecolor=axis_color)
+slide_pixel_midpoint_axis = plt.axes([0.29,  0.1, 0.15, 0.03], facecolor=axis_color)
+slide_pixel_k_axis =        plt.axes([0.29, 0.15, 0.15, 0.03], facecolor=axis_color)
+slide_views_midpoint_axis = plt.axes([0.52,  0.1, 0.15, 0.03], facecolor=axis_color)
+slide_views_k_axis =        plt.axes([0.52, 0.15, 0.15, 0.03], facecolor=axis_color)
 
 slide_ratio_midpoint = Slider(slide_ratio_midpoint_axis, 'midpoint', 0, 1, valinit=config.ratio_midpoint)
 slide_pixel_midpoint = Slider(slide_pixel_midpoint_axis, 'midpoint', 0, 1, valinit=config.pixel_midpoint)
@@ -51,66 +90,64 @@ slide_pixel_k = Slider(slide_pixel_k_axis, 'k', 0, 40, valinit=config.pixel_k)
 slide_views_k = Slider(slide_views_k_axis, 'k', 0, 40, valinit=config.views_k)
 
 #-------------- Plots -----------------
-ax.hold()
 
 # just create plots with zeroed data for now.  the plots will be updated with data later
-plot_ratio_axis = plt.subplot(1,4,1)
+plot_ratio_axis = plt.subplot(1,5,1)
 plot_ratio, = plt.plot(0, 1, lw=2, color='gray')
 plt.title('Ratio')
 plt.axis([0, 1, 0, 1])
-plot_ratio_score_a, = plot_ratio_axis.plot(0, 0, 'ro')
-plot_ratio_score_b, = plot_ratio_axis.plot(0, 0, 'bo')
+plot_ratio_scores = [plot_ratio_axis.plot(0, 0, color + 'o')[0] for color in colors[:len(ids)]]
 ratio_score_ratio_text = plot_ratio_axis.text(.05, .95, '')
 
-plot_pixel_axis = plt.subplot(1,4,2)
+plot_pixel_axis = plt.subplot(1,5,2)
 plt.title('Pixel')
 plot_pixel, = plt.plot(0, 0, lw=2, color='gray')
 plt.axis([0, 1, 0, 1])
-plot_pixel_score_a, = plot_pixel_axis.plot(0, 0, 'ro')
-plot_pixel_score_b, = plot_pixel_axis.plot(0, 0, 'bo')
+plot_pixel_scores = [plot_pixel_axis.plot(0, 0, color + 'o')[0] for color in colors[:len(ids)]]
 pixel_score_ratio_text = plot_pixel_axis.text(.05, .95, '')
 
-plot_views_axis = plt.subplot(1,4,3)
+plot_views_axis = plt.subplot(1,5,3)
 plt.title('Views')
 plot_views, = plt.plot(0, 0, lw=2, color='gray')
 plt.axis([0, 1, 0, 1])
-plot_views_score_a, = plot_views_axis.plot(0, 0, 'ro')
-plot_views_score_b, = plot_views_axis.plot(0, 0, 'bo')
+plot_views_scores = [plot_views_axis.plot(0, 0, color + 'o')[0] for color in colors[:len(ids)]]
 views_score_ratio_text = plot_views_axis.text(.05, .95, '')
 
-plot_final_score_axis = plt.subplot(1,4,4)
+plot_final_score_axis = plt.subplot(1,5,4)
 plt.title('Final Score')
-bbox_a = dict(boxstyle='round', facecolor='red', alpha=0.2)
-bbox_b = dict(boxstyle='round', facecolor='blue', alpha=0.2)
 plot_final_score_axis.axis('off')
-final_score_a_text = plot_final_score_axis.text(.05, .85, '', bbox=bbox_a)
-final_score_b_text = plot_final_score_axis.text(.05, .75, '', bbox=bbox_b)
-final_score_ratio_text = plot_final_score_axis.text(.05, .65, '')
+final_score_texts = [plot_final_score_axis.text(.05, .85 - .1 * i, '', bbox=dict(boxstyle='round', facecolor=color, alpha=0.2))
+                     for i, color in enumerate(colors[:len(ids)])]
+final_score_ratio_text = plot_final_score_axis.text(.05, .85 - .1 * len(ids), '')
+
+# histogram of log10 scores over the whole cache, with bars updated in place
+plot_histogram_axis = plt.subplot(1,5,5)
+plt.title('Scores of {} images'.format(len(corpus)))
+plot_histogram_axis.set_xlabel('log10(score)')
+histogram_bins = np.linspace(-12, 0, 49)
+histogram_bars = plot_histogram_axis.bar(histogram_bins[:-1], np.zeros(len(histogram_bins) - 1),
+                                         width=histogram_bins[1] - histogram_bins[0], align='edge', color='gray')
+plot_histogram_axis.set_xlim(histogram_bins[0], histogram_bins[-1])
+histogram_text = plot_histogram_axis.text(.05, .85, '', transform=plot_histogram_axis.transAxes)
 
 plot_ratio.set_xdata(x)
 plot_pixel.set_xdata(x)
 plot_views.set_xdata(x)
 
-#-------------- Load Images -----------------
-
-def get_image(image_id):
-    for image in images:
-        if image['id'] == image_id:
-            return image
-    else:
-        logger.error('Image ID {} not found in cache.'.format(image_id))
-        sys.exit()
+#-------------- Make plots interactive -----------------
 
-f = open(config.cache_file, 'r')
-j = json.loads(f.read())
-images = j['images']
-max_views = max([image['views'] for image in images])
-image_a = get_image(args.image_id_a)
-image_b = get_image(args.image_id_b)
+# relative probability of the first two images
+def relative(scores):
+    return 'rel. prob. = {:.2e}'.format(scores[0] / scores[1]) if len(scores) > 1 else ''
 
-#-------------- Make plots interactive -----------------
+# update curves as soon as sliders are adjusted
+def update_curves(*_):
+    plot_ratio.set_ydata(redrum.logistic_function(x, slide_ratio_midpoint.val, slide_ratio_k.val))
+    plot_pixel.set_ydata(redrum.logistic_function(x, slide_pixel_midpoint.val, slide_pixel_k.val))
+    plot_views.set_ydata(redrum.logistic_function(x, slide_views_midpoint.val, slide_views_k.val))
+    fig.canvas.draw_idle()
 
-# update plots and scores when sliders are adjusted
+# rescore the whole cache and update scores once sliders stop moving
 def update(*_):
     config.ratio_midpoint = slide_ratio_midpoint.val
     config.ratio_k = slide_ratio_k.val
@@ -118,52 +155,58 @@ def update(*_):
     config.pixel_k = slide_pixel_k.val
     config.views_midpoint = slide_views_midpoint.val
     config.views_k = slide_views_k.val
-    plot_ratio.set_ydata(redrum.logistic_function(x, slide_ratio_midpoint.val, slide_ratio_k.val))
-    plot_pixel.set_ydata(redrum.logistic_function(x, slide_pixel_midpoint.val, slide_pixel_k.val))
-    plot_views.set_ydata(redrum.logistic_function(x, slide_views_midpoint.val, slide_views_k.val))
-    [final_score_a,
-     ratio_score_a,
-     views_score_a,
-     pixel_score_a,
-     ratio_logistic_score_a,
-     views_logistic_score_a,
-     pixel_logistic_score_a] = redrum.score_image(config, image_a, max_views)
-    [final_score_b,
-     ratio_score_b,
-     views_score_b,
-     pixel_score_b,
-     ratio_logistic_score_b,
-     views_logistic_score_b,
-     pixel_logistic_score_b] = redrum.score_image(config, image_b, max_views)
-    plot_ratio_score_a.set_xdata(ratio_score_a)
-    plot_ratio_score_a.set_ydata(ratio_logistic_score_a)
-    plot_ratio_score_b.set_xdata(ratio_score_b)
-    plot_ratio_score_b.set_ydata(ratio_logistic_score_b)
-    ratio_score_ratio_text.set_text('rel. prob. = {:.2e}'.format(ratio_logistic_score_a / ratio_logistic_score_b))
-
-    plot_pixel_score_a.set_xdata(pixel_score_a)
-    plot_pixel_score_a.set_ydata(pixel_logistic_score_a)
-    plot_pixel_score_b.set_xdata(pixel_score_b)
-    plot_pixel_score_b.set_ydata(pixel_logistic_score_b)
-    pixel_score_ratio_text.set_text('rel. prob. = {:.2e}'.format(pixel_logistic_score_a / pixel_logistic_score_b))
-
-    plot_views_score_a.set_xdata(views_score_a)
-    plot_views_score_a.set_ydata(views_logistic_score_a)
-    plot_views_score_b.set_xdata(views_score_b)
-    plot_views_score_b.set_ydata(views_logistic_score_b)
-    views_score_ratio_text.set_text('rel. prob. = {:.2e}'.format(views_logistic_score_a / views_logistic_score_b))
-
-    final_score_a_text.set_text('{} score = {:.2e}'.format(args.image_id_a, final_score_a))
-    final_score_b_text.set_text('{} score = {:.2e}'.format(args.image_id_b, final_score_b))
-    final_score_ratio_text.set_text('rel. prob. = {:.2e}'.format(final_score_a / final_score_b))
+
+    [final_score,
+     ratio_score,
+     views_score,
+     pixel_score,
+     ratio_logistic_score,
+     views_logistic_score,
+     pixel_logistic_score] = corpus.score()
+
+    for plot, row in zip(plot_ratio_scores, rows):
+        plot.set_data([ratio_score[row]], [ratio_logistic_score[row]])
+    ratio_score_ratio_text.set_text(relative(ratio_logistic_score[rows]))
+
+    for plot, row in zip(plot_pixel_scores, rows):
+        plot.set_data([pixel_score[row]], [pixel_logistic_score[row]])
+    pixel_score_ratio_text.set_text(relative(pixel_logistic_score[rows]))
+
+    for plot, row in zip(plot_views_scores, rows):
+        plot.set_data([views_score[row]], [views_logistic_score[row]])
+    views_score_ratio_text.set_text(relative(views_logistic_score[rows]))
+
+    weights = corpus.weights(final_score)
+    total_weight = weights.sum()
+    for text, image_id, row in zip(final_score_texts, ids, rows):
+        text.set_text('{} score = {:.2e}, prob. = {:.2e}'.format(
+            image_id, final_score[row], weights[row] / total_weight if total_weight > 0 else 0))
+    final_score_ratio_text.set_text(relative(final_score[rows]))
+
+    counts, _ = np.histogram(np.log10(np.clip(weights[weights > 0], 1e-12, 1)), bins=histogram_bins)
+    for bar, count in zip(histogram_bars, counts):
+        bar.set_height(count)
+    plot_histogram_axis.set_ylim(0, max(counts.max(), 1) * 1.1)
+    histogram_text.set_text('top 1% hold {:.1%} of probability\n{} candidates'.format(
+        tuning.top_share(weights), np.count_nonzero(weights)))
     fig.canvas.draw_idle()
 
-slide_ratio_midpoint.on_changed(update)
-slide_ratio_k.on_changed(update)
-slide_pixel_midpoint.on_changed(update)
-slide_pixel_k.on_changed(update)
-slide_views_midpoint.on_changed(update)
-slide_views_k.on_changed(update)
+# rescoring the whole cache on every slider event would make dragging stutter
+debounce_timer = fig.canvas.new_timer(interval=debounce_interval)
+debounce_timer.single_shot = True
+debounce_timer.add_callback(update)
+
+def changed(*_):
+    update_curves()
+    debounce_timer.stop()
+    debounce_timer.start()
+
+slide_ratio_midpoint.on_changed(changed)
+slide_ratio_k.on_changed(changed)
+slide_pixel_midpoint.on_changed(changed)
+slide_pixel_k.on_changed(changed)
+slide_views_midpoint.on_changed(changed)
+slide_views_k.on_changed(changed)
 
 reset_axes = plt.axes([0.8, 0.025, 0.1, 0.04])
 button = Button(reset_axes, 'Reset', color=axis_color, hovercolor='0.975')
@@ -181,6 +224,7 @@ button.on_clicked(reset)
 
 # initialize plots, pass 
 def main():
+    update_curves()
     update()
     plt.show()
 
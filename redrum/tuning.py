@@ -0,0 +1,169 @@
+## Shared helpers for the tuning tools
+## The cache is loaded once into numpy columns with an id -> row index, so single images
+##   are found without scanning and the whole cache can be rescored in one vectorized pass
+## Sweeps score the whole cache for thousands of logistic parameter combinations at once
+##   by broadcasting combinations along a first axis
+
+import csv
+import itertools
+import logging
+import sys
+
+import numpy as np
+
+from redrum import redrum, snapshot
+
+logger = logging.getLogger(__name__)
+
+
+# images of the score cache as numpy columns
+class Corpus(object):
+    def __init__(self, config):
+        self.config = config
+        try:
+            cache = redrum.load(config)
+        except (IOError, OSError):
+            logger.error("No cache found at {0}.  Run redrum first.".format(config.cache_file))
+            sys.exit()
+        self.images = cache['images']
+
+        # snapshot columns are used as is, json images are converted once
+        if isinstance(self.images, snapshot.ImageTable):
+            columns = self.images.columns
+            self.widths = np.asarray(columns['width'], dtype=float)
+            self.heights = np.asarray(columns['height'], dtype=float)
+            self.views = np.asarray(columns['views'], dtype=float)
+            ids = [self.images.string('id', row) for row in range(len(self.images))]
+        else:
+            self.widths = np.array([image['width'] for image in self.images], dtype=float)
+            self.heights = np.array([image['height'] for image in self.images], dtype=float)
+            self.views = np.array([image['views'] for image in self.images], dtype=float)
+            ids = [image['id'] for image in self.images]
+        self.rows = {image_id: row for row, image_id in enumerate(ids)}
+        self.max_views = self.views.max() if len(ids) else 1
+
+        # seen images aren't selected if `unseen_only` is set, so they hold no probability
+        seen = redrum.Seen.from_json(cache['seen'])
+        seen_ids = set(seen) | set(image_id for position, image_id, when in cache['journal'])
+        self.unseen = np.array([image_id not in seen_ids for image_id in ids], dtype=bool)
+
+    def __len__(self):
+        return len(self.rows)
+
+    # image dict with the given id, or None if it isn't in the cache
+    def image(self, image_id):
+        row = self.rows.get(image_id)
+        return None if row is None else self.images[row]
+
+    # score every image with the current scoring options of `config`
+    # returns the seven score columns of `redrum.score_images`
+    def score(self):
+        return redrum.score_images(self.config, self.widths, self.heights, self.views, self.max_views)
+
+    # selection weight of every image given their final scores
+    def weights(self, final_scores):
+        if self.config.unseen_only:
+            return final_scores * self.unseen
+        return final_scores
+
+    # score the cache for each row of `parameters` (columns ordered as `PARAMETERS`)
+    # returns a dict of metric columns with a value for each combination
+    # images with a pixel score below `low_resolution` count as low resolution
+    # the logistic score of each distinct (midpoint, k) pair is computed once and shared by every combination
+    #   using it, so combinations should draw their pairs from a few values, as `sweep_parameters` does
+    def sweep(self, parameters, low_resolution=0.5, chunk_size=2 ** 22):
+        [_, ratio_score, views_score, pixel_score, _, _, _] = self.score()
+        mask = self.unseen if self.config.unseen_only else np.ones(len(self), dtype=bool)
+        ratio_score, views_score, pixel_score = ratio_score[mask], views_score[mask], pixel_score[mask]
+        low = (pixel_score < low_resolution).astype(float)
+
+        # logistic scores of each distinct pair, and which pair each combination uses
+        logistic = []
+        for i, score in enumerate([ratio_score, views_score, pixel_score]):
+            pairs, index = np.unique(parameters[:, 2 * i:2 * i + 2], axis=0, return_inverse=True)
+            logistic.append((redrum.logistic_function(score, pairs[:, 0:1], pairs[:, 1:2]), index.ravel()))
+
+        metrics = {name: np.zeros(len(parameters)) for name in METRICS}
+        if not len(ratio_score):
+            return metrics
+        # combinations are scored in chunks so the weight matrix stays around `chunk_size` elements
+        step = max(1, chunk_size // max(1, len(ratio_score)))
+        for start in range(0, len(parameters), step):
+            chunk = slice(start, start + step)
+            (ratio_columns, ratio_index), (views_columns, views_index), (pixel_columns, pixel_index) = logistic
+            weights = ratio_columns[ratio_index[chunk]] * views_columns[views_index[chunk]]
+            weights *= pixel_columns[pixel_index[chunk]]
+
+            total = weights.sum(axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                # entropy in bits of the selection distribution, without normalizing every weight first
+                entropy = np.log2(total) - (weights * np.log2(np.where(weights > 0, weights, 1))).sum(axis=1) / total
+                metrics['entropy'][chunk] = np.where(total > 0, entropy, 0)
+                metrics['candidates'][chunk] = np.where(total > 0, 2 ** entropy, 0)
+                metrics['low_res'][chunk] = np.where(total > 0, weights @ low / total, 0)
+                # share held by the top 1% of images, as in `top_share`
+                count = max(1, int(weights.shape[1] * 0.01))
+                top = np.partition(weights, weights.shape[1] - count, axis=1)[:, -count:].sum(axis=1)
+                metrics['top_share'][chunk] = np.where(total > 0, top / total, 0)
+        return metrics
+
+
+# share of the total selection probability held by the `fraction` of images with the highest weights
+def top_share(weights, fraction=0.01):
+    total = weights.sum()
+    if len(weights) == 0 or total <= 0:
+        return 0.0
+    count = max(1, int(len(weights) * fraction))
+    return np.partition(weights, len(weights) - count)[-count:].sum() / total
+
+
+# logistic parameters varied by a sweep, in the order of their columns
+PARAMETERS = ['ratio_midpoint', 'ratio_k', 'views_midpoint', 'views_k', 'pixel_midpoint', 'pixel_k']
+# range of each kind of parameter, matching the sliders of redrum_tune
+RANGES = {'midpoint': (0, 1), 'k': (0, 40)}
+# metrics reported for each combination
+METRICS = ['entropy', 'candidates', 'low_res', 'top_share']
+
+
+# parameter combinations to sweep, one row per combination
+# with `steps`, every combination of `steps` evenly spaced values of each parameter is used,
+#   otherwise `samples` distinct combinations of `pairs` random (midpoint, k) pairs for each score are drawn
+def sweep_parameters(samples=1000, steps=None, seed=None, pairs=40):
+    ranges = [RANGES[name.split('_')[1]] for name in PARAMETERS]
+    if steps:
+        axes = [np.linspace(low, high, steps) for low, high in ranges]
+        return np.array(list(itertools.product(*axes)))
+    rng = np.random.default_rng(seed)
+    pools = [np.column_stack([rng.uniform(low, high, pairs) for low, high in ranges[i:i + 2]])
+             for i in range(0, len(PARAMETERS), 2)]
+    combinations = rng.choice(pairs ** len(pools), min(samples, pairs ** len(pools)), replace=False)
+    indexes = np.unravel_index(combinations, (pairs,) * len(pools))
+    return np.column_stack([pool[index] for pool, index in zip(pools, indexes)])
+
+
+# order of combinations, most candidates first among those with at most `max_low_res` low resolution mass
+#   and with at least `min_top_share` of the probability on the top 1% of images
+# without a minimum top share, flat weights which hardly discriminate between images always have the most candidates
+def rank(metrics, max_low_res=0.05, min_top_share=0.1):
+    rejected = (metrics['low_res'] > max_low_res) | (metrics['top_share'] < min_top_share)
+    return np.lexsort((-metrics['candidates'], rejected))
+
+
+# write combinations and their metrics in `order` as csv
+def write_table(path, parameters, metrics, order):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['rank'] + PARAMETERS + METRICS)
+        for position, row in enumerate(order, 1):
+            writer.writerow([position] +
+                            ['{:.4g}'.format(value) for value in parameters[row]] +
+                            ['{:.6g}'.format(metrics[name][row]) for name in METRICS])
+
+
+# print the first `count` combinations in `order`
+def print_table(parameters, metrics, order, count=20):
+    print("{:<6}".format("rank") + "".join("{:>16}".format(name) for name in PARAMETERS + METRICS))
+    for position, row in enumerate(order[:count], 1):
+        print("{:<6}".format(position) +
+              "".join("{:>16.4g}".format(value) for value in parameters[row]) +
+              "".join("{:>16.4g}".format(metrics[name][row]) for name in METRICS))
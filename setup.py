@@ -31,7 +31,8 @@ setup(
         "configparser"
     ],
     extras_require={
-        'tune': ['matplotlib', 'numpy']
+        'tune': ['matplotlib', 'numpy'],
+        'resize': ['Pillow']
     },
     classifiers=[
         "Programming Language :: Python :: 2",